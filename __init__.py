@@ -1,6 +1,12 @@
 from variable import *
 from function import *
 from evaluation import *
+from storage import *
+from launchers import LocalLauncher
+from launchers import WorkerLauncher
+from launchers import BatchLauncher
+from worker import WorkerDaemon
+from tracing import Tracer
 from documentation import *
 from tools import LabelReplacer
 from tools import ArrayLabelReplacer
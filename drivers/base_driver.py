@@ -16,8 +16,12 @@
 #  along with FADO.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
-import shutil
+import atexit
+import contextlib
 import numpy as np
+from storage import DesignArchiver, archiveDesign
+from evaluation import ExternalRun
+from tracing import traceSpan
 
 
 class DriverBase:
@@ -55,6 +59,9 @@ class DriverBase:
         self._funReady = False
         self._jacReady = False
         self._nVar = 0
+        # the function values are those of the design in the work directory (unlike
+        # _funReady this is not cleared by updates of the parameters and penalties)
+        self._valuesReady = False
         self._x = None
 
         # functions by role
@@ -70,20 +77,34 @@ class DriverBase:
         # map the start index of each variable in the design vector
         self._variableStartMask = None
 
+        # persistent store of function values and gradients
+        self._database = None
+        self._dbKey = None
+        self._functionIds = {}
+        self._valuesFromDb = False
+
         self._userDir = ""
         self._workDir = "__WORKDIR__"
         self._dirPrefix = "DSN_"
         self._keepDesigns = True
+        self._compress = None
+        self._archive = None
+        self._archiver = None
         self._failureMode = "HARD"
+        self._abortGrace = 5.0
         self._logObj = None
         self._logColWidth = 13
         self._hisObj = None
         self._hisDelim = ",  "
+        self._tracer = None
 
         self._userPreProcessFun = None
         self._userPreProcessGrad = None
         self._userPostProcessFun = None
         self._userPostProcessGrad = None
+
+        # processes still running at exit (e.g. after Ctrl-C) would be orphaned
+        atexit.register(self._abortEvaluations)
     #end
 
     def addObjective(self,type,function,scale=1.0,weight=1.0):
@@ -138,6 +159,13 @@ class DriverBase:
         self._logObj = obj
         self._logColWidth = width
 
+    def setTracer(self,tracer):
+        """
+        Attach a Tracer to the driver, to record the timeline of the optimization (must be
+        called before preprocessing, the tracer is passed to the functions and evaluations).
+        """
+        self._tracer = tracer
+
     def setHistorian(self,obj,delim=",  "):
         """Attach a history file object to the driver, function values printed every iteration."""
         self._hisObj = obj
@@ -190,6 +218,12 @@ class DriverBase:
                 evl.updateVariables(obj.function.getVariables())
             for evl in obj.function.getGradientEvalChain():
                 evl.updateVariables(obj.function.getVariables())
+
+            if self._tracer is not None:
+                obj.function.setTracer(self._tracer)
+                for evl in obj.function.getValueEvalChain()+obj.function.getGradientEvalChain():
+                    evl.setTracer(self._tracer)
+            #end
         #end
     #end
 
@@ -210,6 +244,15 @@ class DriverBase:
 
         self._varScales = self._getConcatenatedVector("Scale")
 
+        # identify each unique function (a function may have multiple roles)
+        self._functionIds = {}
+        for flist in (self._objectives,self._constraintsEQ,self._constraintsGT):
+            for obj in flist:
+                if obj.function not in self._functionIds:
+                    self._functionIds[obj.function] = "f"+str(len(self._functionIds))
+            #end
+        #end
+
         # initialize current values such that evaluations are triggered on first call
         self._nVar = self.getNumVariables()
         self._x = np.ones([self._nVar,])*1e20
@@ -218,7 +261,8 @@ class DriverBase:
         self._userDir = os.path.abspath(os.curdir)
     #end
 
-    def setStorageMode(self,keepDesigns=False,dirPrefix="DSN_"):
+    def setStorageMode(self,keepDesigns=False,dirPrefix="DSN_",background=False,compress=None,
+                       maxQueued=2,archive=None):
         """
         Set whether to keep or discard (default) old optimization iterations.
 
@@ -226,9 +270,71 @@ class DriverBase:
         ----------
         keepDesigns : True to keep all designs.
         dirPrefix   : Prefix used to name folders with old designs.
+        background  : True to delete/move old designs on a background thread, the working
+                      directory is renamed and the optimization continues immediately.
+        compress    : Archive format (e.g. "gztar", see shutil.make_archive) for kept designs.
+        maxQueued   : Maximum number of designs waiting to be processed in the background.
+        archive     : DesignArchive where kept designs are stored, with their function values.
         """
         self._keepDesigns = keepDesigns
         self._dirPrefix = dirPrefix
+        self._compress = compress
+        self._archive = archive
+
+        if self._archiver is not None: self._archiver.flush()
+        self._archiver = None
+        if background:
+            self._archiver = DesignArchiver(compress,maxQueued,archive)
+            atexit.register(self._archiver.flush)
+        #end
+    #end
+
+    def flushStorage(self):
+        """Wait for the old designs being processed in the background, see setStorageMode."""
+        if self._archiver is not None: self._archiver.flush()
+
+    def setEvaluationCache(self,cache):
+        """
+        Set an EvaluationCache for all the evaluation steps of the functions added to the
+        driver, runs whose inputs did not change (e.g. after a parameter update) are not
+        repeated. Must be called after all functions are added to the driver.
+        """
+        for flist in (self._objectives,self._constraintsEQ,self._constraintsGT):
+            for obj in flist:
+                for evl in obj.function.getValueEvalChain()+obj.function.getGradientEvalChain():
+                    evl.setCache(cache)
+            #end
+        #end
+    #end
+
+    def setDatabase(self,database):
+        """
+        Set an EvaluationDatabase, function values and gradients are read from it if the
+        design (and parameters) were evaluated before, otherwise they are stored in it.
+        This allows restarting an optimization (that replays the same iterates) after a crash.
+        """
+        self._database = database
+
+    # get the gradient of a function, consulting the database first
+    def _getGradient(self,function):
+        # in sequential mode the evaluations run here
+        with self._abortOnError():
+            with traceSpan(self._tracer,"gradient "+function.getName(),"assembly"):
+                return self._getGradientFromDb(function)
+    #end
+
+    def _getGradientFromDb(self,function):
+        if self._database is None:
+            return function.getGradient(self._variableStartMask)
+
+        name = self._functionIds[function]
+        gradient = self._database.getGradient(self._dbKey,name)
+        if gradient is None:
+            gradient = function.getGradient(self._variableStartMask)
+            self._database.setGradient(self._dbKey,name,gradient)
+        #end
+        return gradient
+    #end
 
     def setFailureMode(self,mode):
         """
@@ -239,6 +345,14 @@ class DriverBase:
         assert mode == "HARD" or mode == "SOFT", "Mode must be either \"HARD\" (exceptions) or \"SOFT\" (default function values)."
         self._failureMode = mode
 
+    def setAbortGracePeriod(self,grace):
+        """
+        Set the time (s) the processes of the evaluations have to exit after SIGTERM, before
+        they are killed. Evaluations in flight are stopped when the design changes, when one
+        fails in "HARD" mode, on interruption (e.g. Ctrl-C), and at exit.
+        """
+        self._abortGrace = grace
+
     def setUserPreProcessFun(self,callableOrString):
         """Set a preprocessing action executed before evaluating function values."""
         self._userPreProcessFun = callableOrString
@@ -255,6 +369,28 @@ class DriverBase:
         """Set a postprocessing action executed after evaluating function gradients."""
         self._userPostProcessGrad = callableOrString
 
+    def _abortEvaluations(self):
+        evals = []
+        for obj in self._objectives+self._constraintsEQ+self._constraintsGT:
+            for evl in obj.function.getValueEvalChain()+obj.function.getGradientEvalChain():
+                if evl not in evals: evals.append(evl)
+        #end
+        ExternalRun.abortRuns(evals,self._abortGrace)
+    #end
+
+    # stop the evaluations in flight if an exception propagates, unless failures are
+    # tolerated ("SOFT" mode), interruptions (e.g. Ctrl-C) always stop them
+    @contextlib.contextmanager
+    def _abortOnError(self):
+        try:
+            yield
+        except BaseException as error:
+            if self._failureMode == "HARD" or not isinstance(error,Exception):
+                self._abortEvaluations()
+            raise
+        #end
+    #end
+
     def _resetAllValueEvaluations(self):
         for obj in self._objectives:
             obj.function.resetValueEvalChain()
@@ -287,6 +423,65 @@ class DriverBase:
         self._hisObj.write(hisLine)
     #end
 
+    def setScratch(self,root,keep=False):
+        """
+        Stage and execute all the evaluation steps in temporary directories under "root"
+        (e.g. tmpfs or a local disk), see ExternalRun.setScratch. Besides the expected files,
+        the files used as data by other runs, or read by the functions, are copied back to
+        the working directory. The scratch directories of the last design are removed at
+        exit (unless keep=True). Must be called after all functions are added to the driver.
+        """
+        functions = [obj.function for obj in self._objectives+self._constraintsEQ+self._constraintsGT]
+        evals = []
+        for function in functions:
+            for evl in function.getValueEvalChain()+function.getGradientEvalChain():
+                if evl not in evals: evals.append(evl)
+        #end
+
+        # files (relative to the working directory) that are needed after the runs
+        needed = []
+        for function in functions:
+            needed += function.getOutputFiles()
+        for evl in evals:
+            needed += evl.getDataFiles()
+        needed = [os.path.normpath(file) for file in needed if file and not os.path.isabs(file)]
+
+        for evl in evals:
+            evl.setScratch(root,keep)
+            dir = os.path.normpath(evl.getWorkDir())
+            for file in needed:
+                if file != dir and os.path.commonpath([file,dir]) == dir:
+                    evl.addOutput(os.path.relpath(file,dir))
+            #end
+        #end
+        if not keep: atexit.register(self._removeScratch,evals)
+    #end
+
+    # finalizing the runs removes their scratch directories, the processes are stopped
+    # first, otherwise they would not be aborted at exit (the runs are then reset)
+    def _removeScratch(self,evals):
+        self._abortEvaluations()
+        for evl in evals: evl.finalize()
+    #end
+
+    # iteration, function values, objective, and constraint violation of the current
+    # design, to be recorded in a DesignArchive
+    def _designRecord(self):
+        if not self._valuesReady: return (self._funEval,None,None,None)
+
+        values = {}
+        for obj,f in zip(self._objectives,self._ofval):
+            values[obj.function.getName()] = float(f/obj.scale)
+        for obj,f in zip(self._constraintsEQ+self._constraintsGT,list(self._eqval)+list(self._gtval)):
+            values[obj.function.getName()] = float(f/obj.scale+obj.bound)
+
+        violation = 0.0
+        for f in self._eqval: violation = max(violation,abs(f))
+        for f in self._gtval: violation = max(violation,-f)
+
+        return (self._funEval,values,float(self._ofval.sum()),float(violation))
+    #end
+
     # Detect a change in the design vector, reset directories and evaluation state.
     def _handleVariableChange(self, x):
         assert x.size == self._nVar, "Wrong size of design vector."
@@ -296,31 +491,45 @@ class DriverBase:
         if not newValues: return False
 
         # otherwise...
+        with traceSpan(self._tracer,"design change","driver"):
+            self._changeDesign(x)
+        return True
+    #end
+
+    def _changeDesign(self, x):
+        # evaluations left running (e.g. speculative) are for the previous design
+        self._abortEvaluations()
 
         # update the values of the variables
         self._setCurrent(x)
         self._x[()] = x
 
+        if self._database is not None:
+            paramValues = [par.getValue() for par in self._parameters]
+            self._dbKey = self._database.getKey(self._x,paramValues)
+        self._valuesFromDb = False
+
         # manage working directories
         os.chdir(self._userDir)
         if os.path.isdir(self._workDir):
+            dirName = None
             if self._keepDesigns:
                 dirName = self._dirPrefix+str(self._funEval).rjust(3,"0")
-                if os.path.isdir(dirName): shutil.rmtree(dirName)
-                os.rename(self._workDir,dirName)
+            if self._archiver is not None:
+                self._archiver.archive(self._workDir,dirName,self._designRecord())
+            elif self._archive is not None and dirName is not None:
+                self._archive.store(self._workDir,dirName,*self._designRecord())
             else:
-                shutil.rmtree(self._workDir)
-            #end
+                archiveDesign(self._workDir,dirName,self._compress)
         #end
         os.mkdir(self._workDir)
 
         # trigger evaluations
+        self._valuesReady = False
         self._funReady = False
         self._jacReady = False
         self._resetAllValueEvaluations()
         self._resetAllGradientEvaluations()
-
-        return True
     #end
 #end
 
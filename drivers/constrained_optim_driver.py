@@ -49,6 +49,7 @@ class ConstrainedOptimizationDriver(ParallelEvalDriver):
         self._x[()] = 1e20
         self._funReady = False
         self._jacReady = False
+        self._abortEvaluations()
         self._resetAllValueEvaluations()
         self._resetAllGradientEvaluations()
 
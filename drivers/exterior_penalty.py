@@ -89,8 +89,16 @@ class ExteriorPenaltyDriver(ParallelEvalDriver):
         # write the header for the log file and set the format
         if self._logObj is not None:
             w = self._logColWidth
-            headerData = ["FUN EVAL","FUN TIME","GRAD EVAL","GRAD TIME","FEASIBLE"]
-            self._logRowFormat = "{:>W}"+"{:>W.3e}{:>W}"*2
+            headerData = ["FUN EVAL","FUN TIME","GRAD EVAL","GRAD TIME"]
+            self._logRowFormat = "{:>W}{:>W.3e}"*2
+            if self._tokenPools:
+                headerData.append("TOKEN TIME")
+                self._logRowFormat += "{:>W.3e}"
+            if self._logUsage:
+                headerData += ["CPU TIME","MAX RSS (MB)"]
+                self._logRowFormat += "{:>W.3e}"*2
+            headerData.append("FEASIBLE")
+            self._logRowFormat += "{:>W}"
             for obj in self._objectives:
                 headerData.append(obj.function.getName(w-1))
                 self._logRowFormat += "{:>W.Pg}"
@@ -130,6 +138,8 @@ class ExteriorPenaltyDriver(ParallelEvalDriver):
     def _writeLogLine(self):
         if self._logObj is None: return
         data = [self._funEval, self._funTime, self._jacEval, self._jacTime]
+        if self._tokenPools: data.append(self._tokenTime)
+        if self._logUsage: data += self._getResourceUsage()
         data.append(("NO","YES")[self._isFeasible])
         for f in self._ofval:
             data.append(f)
@@ -160,7 +170,7 @@ class ExteriorPenaltyDriver(ParallelEvalDriver):
         try:
             self._evaluateGradients(x)
             return self._grad
-        except:
+        except Exception:
             if self._failureMode == "HARD": raise
             return self._old_grad
         #end
@@ -180,14 +190,14 @@ class ExteriorPenaltyDriver(ParallelEvalDriver):
         self._grad[()] = 0.0
 
         for obj in self._objectives:
-            self._grad += obj.function.getGradient(self._variableStartMask)*obj.scale
+            self._grad += self._getGradient(obj.function)*obj.scale
 
         for (obj,f,r) in zip(self._constraintsEQ,self._eqval,self._eqpen):
-            self._grad += 2.0*r*f*obj.function.getGradient(self._variableStartMask)*obj.scale
+            self._grad += 2.0*r*f*self._getGradient(obj.function)*obj.scale
 
         for (obj,f,r) in zip(self._constraintsGT,self._gtval,self._gtpen):
             if f < 0.0:
-                self._grad += 2.0*r*f*obj.function.getGradient(self._variableStartMask)*obj.scale
+                self._grad += 2.0*r*f*self._getGradient(obj.function)*obj.scale
 
         self._grad /= self._varScales
 
@@ -237,6 +247,7 @@ class ExteriorPenaltyDriver(ParallelEvalDriver):
         self._x[()] = 1e20
         self._funReady = False
         self._jacReady = False
+        self._abortEvaluations()
         self._resetAllValueEvaluations()
         self._resetAllGradientEvaluations()
 
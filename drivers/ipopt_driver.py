@@ -82,12 +82,12 @@ class IpoptDriver(ConstrainedOptimizationDriver):
 
             out[()] = 0.0
             for obj in self._objectives:
-                out += obj.function.getGradient(self._variableStartMask) * obj.scale
+                out += self._getGradient(obj.function) * obj.scale
             out /= self._varScales
 
             # keep reference to result to use as fallback on next iteration if needed
             self._old_grad_f = out
-        except:
+        except Exception:
             if self._failureMode == "HARD": raise
             if self._old_grad_f is None: out[()] = 0.0
             else: out[()] = self._old_grad_f
@@ -128,15 +128,13 @@ class IpoptDriver(ConstrainedOptimizationDriver):
             os.chdir(self._workDir)
 
             i = 0
-            mask = self._variableStartMask
-
             for con in self._constraintsEQ:
-                out[i:(i+self._nVar)] = con.function.getGradient(mask) * con.scale / self._varScales
+                out[i:(i+self._nVar)] = self._getGradient(con.function) * con.scale / self._varScales
                 i += self._nVar
             #end
             for (con,f) in zip(self._constraintsGT, self._gtval):
                 if f < 0.0 or not self._asNeeded:
-                    out[i:(i+self._nVar)] = con.function.getGradient(mask) * con.scale / self._varScales
+                    out[i:(i+self._nVar)] = self._getGradient(con.function) * con.scale / self._varScales
                 else:
                     out[i:(i+self._nVar)] = 0.0
                 #end
@@ -145,7 +143,7 @@ class IpoptDriver(ConstrainedOptimizationDriver):
 
             # keep reference to result to use as fallback on next iteration if needed
             self._old_jac_g = out
-        except:
+        except Exception:
             if self._failureMode == "HARD": raise
             if self._old_jac_g is None: out[()] = 0.0
             else: out[()] = self._old_jac_g
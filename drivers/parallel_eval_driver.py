@@ -16,16 +16,53 @@
 #  along with FADO.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import glob
 import time
+import asyncio
+import selectors
 import subprocess as sp
+import concurrent.futures
+import numpy as np
 from drivers.base_driver import DriverBase
+from tracing import traceSpan
+
+
+# parse a Linux CPU list, e.g. "0-3,8,10-11"
+def _parseCpuList(text):
+    cpus = set()
+    for item in text.strip().split(","):
+        if not item: continue
+        bounds = item.split("-")
+        cpus.update(range(int(bounds[0]),int(bounds[-1])+1))
+    #end
+    return cpus
+#end
+
+# the CPUs available to this process grouped by NUMA node
+def _numaNodes():
+    try:
+        available = os.sched_getaffinity(0)
+    except AttributeError:
+        available = set(range(os.cpu_count()))
+
+    nodes = []
+    for file in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        with open(file) as f:
+            cpus = _parseCpuList(f.read()) & available
+        if cpus: nodes.append(cpus)
+    #end
+    other = available-set().union(*nodes)
+    if other: nodes.append(other)
+    return nodes
+#end
 
 
 class ParallelEvalDriver(DriverBase):
     """
     Intermediate class that adds parallel evaluation capabilities to the base driver.
     In parallel mode, the evaluation steps of the functions are started asynchronously
-    as soon as all their dependencies are met.
+    as soon as all their dependencies are met, the driver sleeps until one of the
+    running processes exits.
 
     Parameters
     ----------
@@ -40,99 +77,813 @@ class ParallelEvalDriver(DriverBase):
         self._jacTime = 0
         self._funEval = 0
         self._jacEval = 0
+        self._tokenTime = 0
+        self._cpuTime = 0.0
+        self._logUsage = False
 
         # variables for parallelization of evaluations
         self._asNeeded = asNeeded
         self._parallelEval = False
-        self._funEvalGraph = None
-        self._jacEvalGraph = None
+        self._evalGraph = None
+        self._evalKinds = None
         self._waitTime = 10.0
+        self._useAsyncio = False
+        self._eventLoop = None
+        self._coreBudget = 0
+        self._tokenPools = {}
+        self._cpuNodes = None
+        self._freeCpus = []
+        self._cpuSets = {}
+        self._schedObj = None
+        self._schedule = {}
+        self._pathLengths = {}
+        self._scheduleReports = []
+        self._speculative = False
+        self._wantedGrads = set()
+        self._speculated = set()
+        self._stagingPool = None
+        self._wakePipe = None
+        self._parsingPool = None
+        self._readers = {}
     #end
 
-    def setEvaluationMode(self,parallel=True,waitTime=10.0):
+    def setEvaluationMode(self,parallel=True,waitTime=10.0,useAsyncio=False):
         """
         Set parallel or sequential (default) evaluation modes. In parallel mode the
-        driver will check if it can start new evaluations every "waitTime" seconds.
-        Builds the evaluation graphs (dependencies) for parallel execution.
+        driver starts new evaluations as soon as their dependencies finish, "waitTime"
+        is only used as the polling interval on platforms where processes cannot be
+        waited on (no pidfd support).
+        If useAsyncio=True the evaluation graph is run as asyncio tasks (see setEventLoop).
+        Builds the evaluation graph (dependencies) for parallel execution, see
+        getEvaluationGraph.
         """
         self._parallelEval = parallel
         if not parallel: return # no need to build graphs
         self._waitTime = waitTime
+        self._useAsyncio = useAsyncio
+
+        # get all unique evaluation steps, those needed for values and gradients are
+        # value evaluations
+        functions = [obj.function for obj in self._objectives+self._constraintsEQ+self._constraintsGT]
+        self._evalKinds = {}
+        for function in functions:
+            for evl in function.getGradientEvalChain():
+                self._evalKinds[evl] = "gradient"
+        for function in functions:
+            for evl in function.getValueEvalChain():
+                self._evalKinds[evl] = "value"
+        #end
+
+        # for each unique evaluation list its direct dependencies, the previous steps of
+        # the chains, the runs in whose directories its data files are, and the explicit ones
+        self._evalGraph = dict((evl,set()) for evl in self._evalKinds)
+
+        for function in functions:
+            for evals in (function.getValueEvalChain(),function.getGradientEvalChain()):
+                for i in range(1,len(evals)):
+                    self._evalGraph[evals[i]].add(evals[i-1])
+        #end
 
-        # get all unique evaluation steps
-        valEvals = set()
-        jacEvals = set()
+        dirs = dict((os.path.normpath(evl.getWorkDir()),evl) for evl in self._evalGraph)
+        for evl,depList in self._evalGraph.items():
+            for file in evl.getDataFiles():
+                parts = os.path.normpath(file).split(os.sep)
+                for i in range(1,len(parts)):
+                    dep = dirs.get(os.path.join(*parts[0:i]))
+                    if dep is not None and dep is not evl: depList.add(dep)
+                #end
+            #end
+            for dep in evl.getDependencies():
+                if dep in self._evalGraph: depList.add(dep)
+        #end
+
+        self._checkCycles()
+
+        # the functions whose files may be read when each evaluation finishes
+        self._readers = dict((evl,[]) for evl in self._evalGraph)
+        for function in functions:
+            for evl in set(function.getValueEvalChain()+function.getGradientEvalChain()):
+                self._readers[evl].append(function)
+        #end
+    #end
 
-        def _addEvals(flist,vlist,jlist):
-            for obj in flist:
-                vlist.update(obj.function.getValueEvalChain())
-                jlist.update(obj.function.getGradientEvalChain())
+    # the evaluations would wait for each other forever
+    def _checkCycles(self):
+        state = {}
+        def _visit(evl):
+            state[evl] = 1
+            for dep in self._evalGraph[evl]:
+                if state.get(dep) == 1:
+                    raise ValueError("Cyclic dependency between evaluations '"+\
+                                     evl.getWorkDir()+"' and '"+dep.getWorkDir()+"'.")
+                if dep not in state: _visit(dep)
             #end
+            state[evl] = 2
         #end
-        _addEvals(self._objectives   ,valEvals,jacEvals)
-        _addEvals(self._constraintsEQ,valEvals,jacEvals)
-        _addEvals(self._constraintsGT,valEvals,jacEvals)
+        for evl in self._evalGraph:
+            if evl not in state: _visit(evl)
+    #end
 
-        # for each unique evaluation list its direct dependencies
-        self._funEvalGraph = dict(zip(valEvals,[set() for i in range(len(valEvals))]))
-        self._jacEvalGraph = dict(zip(jacEvals,[set() for i in range(len(jacEvals))]))
+    def getEvaluationGraph(self):
+        """
+        Return the graph of evaluations built by setEvaluationMode, as a dictionary of
+        ExternalRun's to ("value" or "gradient", set of the ExternalRun's they depend on).
+        """
+        return dict((evl,(self._evalKinds[evl],set(deps))) for evl,deps in self._evalGraph.items())
+    #end
 
-        def _addDependencies(flist,funGraph,jacGraph):
-            for obj in flist:
-                evals = obj.function.getValueEvalChain()
-                for i in range(1,len(evals)):
-                    funGraph[evals[i]].add(evals[i-1])
-                    
-                evals = obj.function.getGradientEvalChain()
-                for i in range(1,len(evals)):
-                    jacGraph[evals[i]].add(evals[i-1])
+    def setEventLoop(self,loop):
+        """
+        Set the asyncio event loop used to run the evaluations when useAsyncio=True.
+        The loop must be running in another thread, the synchronous methods of the
+        driver (e.g. fun/grad) submit the evaluations to it and wait for the result,
+        other coroutines (monitoring, I/O, etc.) can share the loop.
+        By default (loop=None) a new event loop is used for each evaluation.
+        """
+        self._eventLoop = loop
+    #end
+
+    def setCoreBudget(self,cores=None):
+        """
+        Limit the number of cores used simultaneously by parallel evaluations, an
+        evaluation is only started if its cores (see ExternalRun.setResources) fit
+        in the budget. By default (cores=None) the budget is the number of CPUs of
+        the machine, 0 removes the limit. Evaluations that do not fit in the budget
+        are started when nothing else is running.
+        """
+        if cores is None: cores = os.cpu_count()
+        self._coreBudget = cores
+    #end
+
+    def setTokenPool(self,name,size):
+        """
+        Define a named pool of tokens (e.g. floating licenses, concurrent writers), an
+        evaluation that requires tokens (see ExternalRun.requireTokens) is only started
+        when enough tokens of the pool are free, i.e. not held by running evaluations.
+        The time spent waiting for tokens is accumulated in the timing counters.
+        """
+        if size < 1: raise ValueError("The size of the pool must be positive.")
+        self._tokenPools[name] = size
+    #end
+
+    def setCpuAffinity(self,enable=True):
+        """
+        Bind each running evaluation (on the local machine) to a disjoint set of cores
+        with the size declared in ExternalRun.setResources, preferably on one NUMA node.
+        The set is given to the processes in FADO_CPU_LIST, for "mpirun --cpu-set" or
+        "taskset -c". Evaluations are only started when enough cores are free, those that
+        need more cores than the machine has get all of them when nothing else runs.
+        """
+        self._cpuNodes = _numaNodes() if enable else None
+    #end
+
+    def setSpeculativeGradients(self,enable=True):
+        """
+        In parallel mode, start the gradient evaluations of a function in the background
+        as soon as its value evaluations finish (for the exterior penalty driver with
+        asNeeded=True, only if the constraint is active). They are used if the gradient is
+        requested at the same design, and killed if the design changes.
+        Not supported by the asyncio backend.
+        """
+        self._speculative = enable
+    #end
+
+    def setStagingThreads(self,num=4):
+        """
+        In parallel mode, stage the runs (create their directories, copy the files and
+        write the configurations) on "num" threads, the processes are started when their
+        staging completes, 0 stages on the driver thread. Staging time is reported
+        separately from run time (see ExternalRun.getStagingTime and getScheduleReports).
+        """
+        if self._stagingPool is not None: self._stagingPool.shutdown()
+        self._stagingPool = None
+        if num > 0:
+            self._stagingPool = concurrent.futures.ThreadPoolExecutor(num,"FADO_staging")
+        if self._wakePipe is None:
+            self._wakePipe = os.pipe()
+            os.set_blocking(self._wakePipe[0],False)
+        #end
+    #end
+
+    def setParsingThreads(self,num=4):
+        """
+        In parallel mode, read the output and gradient files of the functions on "num"
+        threads as soon as the evaluations that write them finish, instead of when the
+        driver gathers the results (see Function.prefetch), 0 disables this.
+        """
+        if self._parsingPool is not None: self._parsingPool.shutdown()
+        self._parsingPool = None
+        if num > 0:
+            self._parsingPool = concurrent.futures.ThreadPoolExecutor(num,"FADO_parsing")
+    #end
+
+    def setScheduleLogger(self,obj):
+        """
+        Attach a file object to which a line is written after each parallel evaluation,
+        with the critical path (the chain of evaluations that determined the elapsed
+        time) and the capacity (cores) that was left idle, see also getScheduleReports.
+        """
+        self._schedObj = obj
+
+    def getScheduleReports(self):
+        """
+        Return the reports of the parallel evaluations so far, dicts with the "graph"
+        ("VALUE" or "GRADIENT"), "elapsed" time, "critical" path (list of ExternalRun's),
+        "criticalTime", "cores" (the capacity), "idle" (fraction of the capacity), and
+        "staging" (the time spent staging the runs, summed over them).
+        """
+        return self._scheduleReports
+
+    def setResourceLogging(self,enable=True):
+        """
+        Add the CPU time (user+system, of all processes since the previous line) and the
+        peak memory (MB, of the processes of the current design) of the evaluations to the
+        log file, see ExternalRun.getResourceUsage for the details per evaluation.
+        """
+        self._logUsage = enable
+    #end
+
+    # the evaluation steps of all functions
+    def _getEvaluations(self):
+        evals = set()
+        for obj in self._objectives+self._constraintsEQ+self._constraintsGT:
+            evals.update(obj.function.getValueEvalChain())
+            evals.update(obj.function.getGradientEvalChain())
+        #end
+        return evals
+    #end
+
+    # CPU time used since the last call and peak memory of the current design
+    def _getResourceUsage(self):
+        cpuTime = 0.0
+        maxRss = 0
+        for evl in self._getEvaluations():
+            total = evl.getResourceUsage(True)
+            cpuTime += total.get("user",0.0)+total.get("system",0.0)
+            for usage in evl.getResourceUsage():
+                maxRss = max(maxRss,usage["maxrss"])
+        #end
+        cpuTime,self._cpuTime = cpuTime-self._cpuTime,cpuTime
+        return cpuTime,maxRss/1024.0
+    #end
+
+    # the cores of evaluations left running (e.g. speculative ones) remain allocated
+    def _resetCpus(self):
+        self._freeCpus = [set(node) for node in (self._cpuNodes or [])]
+        for evl in list(self._cpuSets):
+            if evl.isIni() and not evl.isRun():
+                for node in self._freeCpus:
+                    for cpus in self._cpuSets[evl]: node.difference_update(cpus)
+            else:
+                del self._cpuSets[evl]
             #end
         #end
-        _addDependencies(self._objectives   ,self._funEvalGraph,self._jacEvalGraph)
-        _addDependencies(self._constraintsEQ,self._funEvalGraph,self._jacEvalGraph)
-        _addDependencies(self._constraintsGT,self._funEvalGraph,self._jacEvalGraph)
     #end
 
+    def _bindsCpus(self,evl):
+        return self._cpuNodes is not None and evl.getLauncher().isLocal()
+
+    # check if an evaluation fits in the cores left unbound by the running ones
+    def _fitsCpus(self,evl,running):
+        if not running or not self._bindsCpus(evl): return True
+        return sum(len(node) for node in self._freeCpus) >= evl.getCores()
+    #end
+
+    # bind an evaluation (or its duplicate) to free cores, the tightest node that fits
+    # is used, otherwise the cores are taken from the nodes with more free cores
+    def _allocateCpus(self,evl):
+        if not self._bindsCpus(evl): return
+        num = evl.getCores()
+        cpus = []
+
+        fits = [node for node in self._freeCpus if len(node) >= num]
+        if fits:
+            cpus = sorted(min(fits,key=len))[0:num]
+        else:
+            # this takes all the free cores if there are not enough
+            for node in sorted(self._freeCpus,key=len,reverse=True):
+                cpus += sorted(node)[0:num-len(cpus)]
+        #end
+
+        if not cpus:
+            evl.setCpuSet(None)
+            return
+        #end
+        for node in self._freeCpus:
+            node.difference_update(cpus)
+        self._cpuSets.setdefault(evl,[]).append(cpus)
+        evl.setCpuSet(cpus)
+    #end
+
+    def _releaseCpus(self,evl):
+        for cpus in self._cpuSets.pop(evl,[]):
+            for node,free in zip(self._cpuNodes,self._freeCpus):
+                free.update(node.intersection(cpus))
+        #end
+    #end
+
+    # check if an evaluation fits in the cores left by the running ones
+    def _fitsCores(self,evl,running):
+        if not running or self._coreBudget <= 0: return True
+        cores = evl.getCores()
+        for other in running:
+            cores += other.getCores()*other.getNumProcesses()
+        return cores <= self._coreBudget
+    #end
+
+    # check if the tokens required by an evaluation are not held by the running ones
+    def _hasTokens(self,evl,running):
+        for pool,num in evl.getTokens().items():
+            if pool not in self._tokenPools:
+                raise ValueError("Evaluation requires tokens from undefined pool '"+pool+"'.")
+            if num > self._tokenPools[pool]:
+                raise ValueError("Evaluation requires more tokens than pool '"+pool+"' has.")
+            for other in running:
+                num += other.getTokens().get(pool,0)*other.getNumProcesses()
+            if num > self._tokenPools[pool]: return False
+        #end
+        return True
+    #end
+
+    # a typo in a pool name would silently lift its limit
+    def _checkTokenPools(self):
+        for evl in self._evalGraph:
+            self._hasTokens(evl,[])
+    #end
+
+    def _canStart(self,evl,running):
+        return self._hasTokens(evl,running) and self._fitsCores(evl,running) and \
+               self._fitsCpus(evl,running) and evl.canLaunch()
+
     # run the active evaluations of a dependency graph
-    def _evalInParallel(self,dependGraph,active):
+    def _evalInParallel(self,dependGraph,active,label):
+        self._activateDependencies(dependGraph,active)
+        self._resetCpus()
+        self._schedule = {}
+        self._pathLengths = self._computePathLengths(dependGraph,active)
+        startTime = time.time()
+
+        # results of evaluations that finished before (e.g. in the background)
+        for evl in dependGraph:
+            if evl.isRun(): self._readResults(evl)
+
+        with self._abortOnError():
+            if not self._useAsyncio:
+                speculate = None
+                if self._speculative and label == "VALUE":
+                    self._wantedGrads = set()
+                    self._speculated = set()
+                    speculate = self._speculativeEvals
+                #end
+                self._evalReadyQueue(dependGraph,active,speculate)
+            elif self._eventLoop is None:
+                asyncio.run(self._evalInParallelAsync(dependGraph,active))
+            else:
+                coro = self._evalInParallelAsync(dependGraph,active)
+                future = asyncio.run_coroutine_threadsafe(coro,self._eventLoop)
+                try:
+                    future.result()
+                except BaseException:
+                    future.cancel()
+                    raise
+                #end
+            #end
+        #end
+
+        self._reportSchedule(label,startTime)
+    #end
+
+    # expected time from the start of each evaluation to the end of the graph, i.e. its
+    # duration plus the longest path through its active dependents, evaluations without
+    # history are assumed to take the average time of the others
+    def _computePathLengths(self,dependGraph,active):
+        durations = dict((evl,evl.getExpectedDuration()) for evl in dependGraph)
+        known = [d for d in durations.values() if d is not None]
+        default = sum(known)/len(known) if known else 1.0
+
+        dependents = dict((evl,[]) for evl in dependGraph)
+        for evl,depList in dependGraph.items():
+            for dep in depList:
+                dependents[dep].append(evl)
+        #end
+
+        lengths = {}
+        def _length(evl):
+            if evl not in lengths:
+                downstream = [_length(dep) for dep in dependents[evl] if active[dep]]
+                duration = durations[evl]
+                if duration is None: duration = default
+                lengths[evl] = duration+max(downstream+[0.0])
+            #end
+            return lengths[evl]
+        #end
+        for evl in dependGraph: _length(evl)
+        return lengths
+    #end
+
+    # an evaluation waits for those with longer paths that can start
+    def _hasPriority(self,evl,waiting,running):
+        for other in waiting:
+            if self._pathLengths[other] > self._pathLengths[evl] and self._canStart(other,running):
+                return False
+        return True
+    #end
+
+    # the capacity of the machine, to measure the idle time
+    def _getCapacity(self):
+        if self._coreBudget > 0: return self._coreBudget
+        if self._cpuNodes is not None: return sum(len(node) for node in self._cpuNodes)
+        return os.cpu_count()
+    #end
+
+    # find the chain of evaluations that ended last, and the fraction of idle capacity
+    def _reportSchedule(self,label,startTime):
+        if not self._schedule: return
+        endTime = time.time()
+        for times in self._schedule.values():
+            if times[1] is None: times[1] = endTime
+
+        # each evaluation of the path waited for the one that finished last before it
+        # started, either a dependency or one that released resources
+        critical = [max(self._schedule,key=lambda evl: self._schedule[evl][1])]
         while True:
-            allRun = True
-            for evl,depList in dependGraph.items():
-                if not active[evl]: continue
+            start = self._schedule[critical[0]][0]
+            before = [evl for evl,times in self._schedule.items() if times[1] <= start]
+            if not before: break
+            critical.insert(0,max(before,key=lambda evl: self._schedule[evl][1]))
+        #end
+        criticalTime = self._schedule[critical[-1]][1]-self._schedule[critical[0]][0]
+
+        elapsed = endTime-startTime
+        cores = self._getCapacity()
+        busy = sum(evl.getCores()*(end-start) for evl,(start,end) in self._schedule.items())
+        idle = max(0.0,1.0-busy/max(cores*elapsed,1e-9))
+
+        staging = sum(evl.getStagingTime() for evl in self._schedule)
+
+        report = {"graph" : label, "elapsed" : elapsed, "critical" : critical,
+                  "criticalTime" : criticalTime, "cores" : cores, "idle" : idle,
+                  "staging" : staging}
+        self._scheduleReports.append(report)
+
+        if self._schedObj is not None:
+            path = " > ".join(evl.getWorkDir() for evl in critical)
+            line = "%s evaluations: %.3g s, critical path %s (%.3g s), idle capacity %.0f%% of %d cores, staging %.3g s\n"
+            self._schedObj.write(line % (label,elapsed,path,criticalTime,100*idle,cores,staging))
+        #end
+    #end
 
-                # ensure all dependencies are active
-                for dep in depList:
+    # ensure all dependencies of active evaluations are active
+    def _activateDependencies(self,dependGraph,active):
+        stack = [evl for evl in dependGraph if active[evl]]
+        while stack:
+            for dep in dependGraph[stack.pop()]:
+                if not active[dep]:
                     active[dep] = True
+                    stack.append(dep)
+            #end
+        #end
+    #end
+
+    # gradient evaluations that can start before the gradients are requested, those of the
+    # functions whose values are known, once their dependencies are met
+    def _speculativeEvals(self):
+        for function in self._speculativeFunctions():
+            self._wantedGrads.update(function.getGradientEvalChain())
+            self._speculated.add(function)
+        #end
+
+        evals = []
+        for evl in self._wantedGrads:
+            if evl.isIni() or evl.isRun(): continue
+            if all(dep.isRun() for dep in self._evalGraph[evl]): evals.append(evl)
+        #end
+        return evals
+    #end
 
-                # either running or finished, move on
-                if evl.isIni() or evl.isRun():
-                    evl.poll() # (starts or updates internal state)
-                    allRun &= evl.isRun()
+    # functions whose value evaluations finished and whose gradients will be needed
+    def _speculativeFunctions(self):
+        functions = []
+        for obj in self._objectives+self._constraintsEQ+self._constraintsGT:
+            if obj.function in self._speculated: continue
+            if not all(evl.isRun() for evl in obj.function.getValueEvalChain()): continue
+            if obj in self._constraintsGT and self._asNeeded:
+                # inactive constraints are not checked again
+                self._speculated.add(obj.function)
+                try:
+                    if (obj.function.getValue()-obj.bound)*obj.scale >= 0.0: continue
+                except Exception:
                     continue
+            #end
+            functions.append(obj.function)
+        #end
+        return functions
+    #end
+
+    # an evaluation is started as soon as its unmet dependency count drops to zero,
+    # "speculate" returns evaluations that are started in the background, i.e. only if
+    # there are resources for them, and without waiting for them to finish
+    def _evalReadyQueue(self,dependGraph,active,speculate=None):
+        # count the unmet dependencies and map evaluations to their dependents
+        dependents = dict((evl,[]) for evl in dependGraph)
+        numDeps = {}
+        for evl,depList in dependGraph.items():
+            if not active[evl]: continue
+            numDeps[evl] = 0
+            for dep in depList:
+                dependents[dep].append(evl)
+                if not dep.isRun(): numDeps[evl] += 1
+            #end
+        #end
+
+        ready = [evl for evl,num in numDeps.items() if num == 0 and not evl.isRun()]
+        running = set()
+        tokenWait = {}
+        readyTime = dict((evl,time.time()) for evl in ready)
+
+        # evaluations that were left running are not restarted
+        for evl in ready:
+            if evl.isIni():
+                running.add(evl)
+                self._schedule[evl] = [time.time(),None]
+            #end
+        #end
+        ready = [evl for evl in ready if evl not in running]
+        background = set()
+        staging = {}
+
+        def _pending(evals):
+            return any(evl not in background for evl in evals)
+
+        try:
+            while True:
+                # start the ready evaluations that fit in the available resources, those
+                # with the longest path to the end of the graph first
+                ready.sort(key=lambda evl: self._pathLengths.get(evl,-1.0),reverse=True)
+                waiting = []
+                for evl in ready:
+                    if not self._hasTokens(evl,running):
+                        tokenWait.setdefault(evl,time.time())
+                        waiting.append(evl)
+                        continue
+                    #end
+                    if evl in tokenWait:
+                        self._tokenTime += time.time()-tokenWait.pop(evl)
+
+                    if self._fitsCores(evl,running) and self._fitsCpus(evl,running) and evl.canLaunch():
+                        self._allocateCpus(evl)
+                        self._traceQueued(evl,readyTime.pop(evl))
+                        if evl not in background: self._schedule[evl] = [time.time(),None]
+                        if self._stagingPool is None:
+                            evl.initialize()
+                        else:
+                            staging[evl] = self._stagingPool.submit(evl.stage,os.getcwd())
+                            staging[evl].add_done_callback(self._wakeDriver)
+                        #end
+                        running.add(evl)
+                    else:
+                        waiting.append(evl)
+                    #end
                 #end
-                allRun &= evl.isRun()
+                ready = waiting
 
-                # if dependencies are met, start evaluation
-                for dep in depList:
-                    if not dep.isRun(): break
-                else:
-                    evl.initialize()
-                    evl.poll()
+                # duplicate stragglers with the resources that are not needed by new evaluations
+                if not ready:
+                    for evl in running:
+                        if evl.isStraggler() and self._canStart(evl,running):
+                            self._allocateCpus(evl)
+                            evl.startDuplicate()
+                #end
+
+                self._flushLaunchers(running)
+                if not _pending(ready) and not _pending(running):
+                    # background evaluations that are still staging are launched before leaving
+                    if not staging: break
+                    concurrent.futures.wait(staging.values())
+                #end
+                self._waitForEvals(running,list(staging.values()))
+
+                # start the processes of the evaluations whose staging completed
+                for evl,future in list(staging.items()):
+                    if not future.done(): continue
+                    del staging[evl]
+                    try:
+                        future.result()
+                        evl.launch()
+                    except Exception:
+                        if evl not in background: raise
+                        self._dropBackground(evl,running)
+                    #end
+                #end
+
+                # update the state of the running evaluations and release their dependents
+                for evl in list(running):
+                    if evl in staging: continue
+                    try:
+                        evl.poll()
+                    except Exception:
+                        if evl not in background: raise
+                        self._dropBackground(evl,running)
+                        continue
+                    #end
+                    if not evl.isRun(): continue
+                    running.remove(evl)
+                    self._releaseCpus(evl)
+                    self._readResults(evl)
+                    if evl in background: continue
+                    self._schedule[evl][1] = time.time()
+                    for dep in dependents[evl]:
+                        numDeps[dep] -= 1
+                        if numDeps[dep] == 0:
+                            ready.append(dep)
+                            readyTime[dep] = time.time()
+                        #end
+                    #end
+                #end
+
+                if speculate is None: continue
+                for evl in speculate():
+                    if evl in background: continue
+                    background.add(evl)
+                    ready.append(evl)
+                    readyTime[evl] = time.time()
                 #end
             #end
-            if allRun: break
-            time.sleep(self._waitTime)
+        finally:
+            # the staging threads write in the run directories, they must not outlive the
+            # pass (e.g. the directories are reset or used sequentially after a failure)
+            for future in staging.values(): future.cancel()
+            concurrent.futures.wait(staging.values())
         #end
     #end
 
+    # a speculative evaluation that failed stops using resources, the failure is reported
+    # if its gradient is requested (the run is not restarted before it is finalized)
+    def _dropBackground(self,evl,running):
+        running.remove(evl)
+        self._releaseCpus(evl)
+    #end
+
+    # each active evaluation is a task that waits for the tasks of its dependencies,
+    # and then for enough resources to be released by the running evaluations
+    async def _evalInParallelAsync(self,dependGraph,active):
+        tasks = {}
+        running = set()
+        waiting = set()
+        released = asyncio.Condition()
+        staging = set()
+
+        async def _evaluate(evl):
+            await asyncio.gather(*[tasks[dep] for dep in dependGraph[evl]])
+            if evl.isRun(): return
+            readyTime = time.time()
+
+            waiting.add(evl)
+            try:
+                async with released:
+                    if not self._hasTokens(evl,running):
+                        waitStart = time.time()
+                        await released.wait_for(lambda: self._hasTokens(evl,running))
+                        self._tokenTime += time.time()-waitStart
+                    #end
+                    await released.wait_for(lambda: self._canStart(evl,running) and \
+                                            self._hasPriority(evl,waiting,running))
+                    waiting.discard(evl)
+                    running.add(evl)
+                    self._allocateCpus(evl)
+                    self._traceQueued(evl,readyTime)
+                    self._schedule[evl] = [time.time(),None]
+                    # the evaluations that gave way to this one may now start
+                    released.notify_all()
+                #end
+            finally:
+                waiting.discard(evl)
+            #end
+            try:
+                if self._stagingPool is not None and not evl.isIni():
+                    future = self._stagingPool.submit(evl.stage,os.getcwd())
+                    staging.add(future)
+                    await asyncio.wrap_future(future)
+                #end
+                await evl.initializeAsync()
+                # deferred processes are started after the other ready tasks had a turn
+                asyncio.get_running_loop().call_soon(evl.getLauncher().flush)
+                await evl.runAsync()
+            finally:
+                async with released:
+                    running.discard(evl)
+                    self._releaseCpus(evl)
+                    self._schedule[evl][1] = time.time()
+                    if evl.isRun():
+                        self._readResults(evl)
+                        _addReady(dependents[evl])
+                    #end
+                    released.notify_all()
+            #end
+        #end
+
+        # the evaluations that become ready together are all waiting before one of them
+        # starts, otherwise the first task to run would not give way to the others
+        dependents = dict((evl,[]) for evl in dependGraph)
+        for evl,depList in dependGraph.items():
+            for dep in depList:
+                dependents[dep].append(evl)
+        #end
+        def _addReady(evals):
+            for evl in evals:
+                if active[evl] and not evl.isRun() and all(dep.isRun() for dep in dependGraph[evl]):
+                    waiting.add(evl)
+            #end
+        #end
+        _addReady(dependGraph)
+
+        for evl in dependGraph:
+            if active[evl]: tasks[evl] = asyncio.ensure_future(_evaluate(evl))
+
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException as error:
+            if self._failureMode == "HARD" or not isinstance(error,Exception):
+                # stop the processes while the event loop can still reap them
+                self._abortEvaluations()
+                for task in tasks.values(): task.cancel()
+            #end
+            # the synchronous code that may use the runs after a failure cannot wait for
+            # asyncio processes, those that were started finish before leaving
+            await asyncio.gather(*tasks.values(),return_exceptions=True)
+            # nor can the staging threads outlive the pass (cancelling a task does not stop them)
+            for future in staging: future.cancel()
+            concurrent.futures.wait(staging)
+            raise
+        #end
+    #end
+
+    # the time an evaluation waited for resources after its dependencies finished
+    def _traceQueued(self,evl,readyTime):
+        if self._tracer is None: return
+        self._tracer.addAsyncSpan("queued "+evl.getWorkDir(),"queue",readyTime,time.time())
+    #end
+
+    # start reading the files of the functions that depend on a finished evaluation
+    def _readResults(self,evl):
+        if self._parsingPool is None: return
+        for function in self._readers.get(evl,[]):
+            function.prefetch(self._parsingPool)
+    #end
+
+    # called by the staging threads to interrupt _waitForEvals
+    def _wakeDriver(self,future):
+        os.write(self._wakePipe[1],b"\0")
+
+    # start the processes deferred by the launchers, e.g. to submit them as one job array
+    def _flushLaunchers(self,running):
+        for launcher in set(evl.getLauncher() for evl in running):
+            launcher.flush()
+    #end
+
+    # sleep until at least one of the running evaluations finishes or reaches a deadline
+    def _waitForEvals(self,running,staging=()):
+        timeout = None
+        selector = selectors.DefaultSelector()
+        try:
+            # a staging thread that completes writes to the pipe
+            if staging:
+                selector.register(self._wakePipe[0],selectors.EVENT_READ)
+                try:
+                    while os.read(self._wakePipe[0],512): pass
+                except BlockingIOError:
+                    pass
+                if any(future.done() for future in staging): return
+            #end
+            for evl in running:
+                # nothing to wait for if an evaluation has already finished
+                if evl.isRun(): return
+                handles = evl.getWaitHandles()
+                if handles is None:
+                    timeout = self._waitTime
+                else:
+                    for handle in handles:
+                        selector.register(handle,selectors.EVENT_READ)
+                deadline = evl.getTimeToDeadline()
+                if deadline is not None:
+                    timeout = deadline if timeout is None else min(timeout,deadline)
+            #end
+            if selector.get_map():
+                selector.select(timeout)
+            elif timeout is not None:
+                time.sleep(timeout)
+        finally:
+            selector.close()
+    #end
+
     # run evaluations extracting maximum parallelism
     def _evalFunInParallel(self):
         self._funTime -= time.time()
 
         # all function evaluations are active by definition
-        active = dict(zip(self._funEvalGraph.keys(), [True]*len(self._funEvalGraph)))
+        active = dict((evl,kind == "value") for evl,kind in self._evalKinds.items())
 
-        self._evalInParallel(self._funEvalGraph, active)
+        self._evalInParallel(self._evalGraph, active, "VALUE")
 
         self._funTime += time.time()
     #end
@@ -141,35 +892,47 @@ class ParallelEvalDriver(DriverBase):
     def _evalJacInParallel(self):
         self._jacTime -= time.time()
 
-        # determine what evaluations are active based on functions
-        active = dict(zip(self._jacEvalGraph.keys(), [False]*len(self._jacEvalGraph)))
+        # determine what evaluations are active based on functions, the value
+        # evaluations they depend on have already run
+        active = dict(zip(self._evalGraph.keys(), [False]*len(self._evalGraph)))
 
-        for obj in self._objectives:
-            for evl in obj.function.getGradientEvalChain():
+        for function in self._gradientFunctions():
+            for evl in function.getGradientEvalChain():
                 active[evl] = True
 
-        for obj in self._constraintsEQ:
-            for evl in obj.function.getGradientEvalChain():
-                active[evl] = True
+        self._evalInParallel(self._evalGraph, active, "GRADIENT")
+
+        self._jacTime += time.time()
+    #end
 
+    # functions whose gradients are needed (the objectives and active constraints)
+    def _gradientFunctions(self):
+        functions = [obj.function for obj in self._objectives+self._constraintsEQ]
         for (obj,f) in zip(self._constraintsGT,self._gtval):
             if f < 0.0 or not self._asNeeded:
-                for evl in obj.function.getGradientEvalChain():
-                    active[evl] = True
-
-        self._evalInParallel(self._jacEvalGraph, active)
+                functions.append(obj.function)
+        return functions
+    #end
 
-        self._jacTime += time.time()
+    # check if the database has all the gradients needed for the current design
+    def _hasStoredGradients(self):
+        if self._database is None: return False
+        for function in self._gradientFunctions():
+            if self._database.getGradient(self._dbKey,self._functionIds[function]) is None:
+                return False
+        return True
     #end
 
     # runs a pre/post processing user action
     def _runAction(self, action):
         if action is None: return
         os.chdir(self._userDir)
-        if isinstance(action,str):
-            sp.call(action,shell=True)
-        else:
-            action()
+        name = action if isinstance(action,str) else getattr(action,"__name__","action")
+        with traceSpan(self._tracer,name,"action"):
+            if isinstance(action,str):
+                sp.call(action,shell=True)
+            else:
+                action()
         #end
     #end
 
@@ -181,36 +944,56 @@ class ParallelEvalDriver(DriverBase):
         # lazy evaluation
         if self._funReady: return False
 
-        self._runAction(self._userPreProcessFun)
+        # values of designs that were evaluated before
+        values = None
+        if self._database is not None:
+            values = self._database.getValues(self._dbKey)
+        self._valuesFromDb = values is not None
 
-        os.chdir(self._workDir)
-
-        if self._parallelEval:
-            try:
-                self._evalFunInParallel()
-            except:
-                if self._failureMode == "HARD": raise
+        if values is None:
+            self._runAction(self._userPreProcessFun)
+            self._evalFunctions()
         #end
 
         self._funEval += 1
         self._funTime -= time.time()
 
+        defaults = []
         def fetchValues(dst, src):
             for i, obj in enumerate(src):
                 try:
                     dst[i] = obj.function.getValue()
-                except:
+                except Exception:
                     if obj.function.hasDefaultValue() and self._failureMode == "SOFT":
                         dst[i] = obj.function.getDefaultValue()
+                        defaults.append(obj)
                     else:
                         raise
                 #end
             #end
         #end
 
-        fetchValues(self._ofval, self._objectives)
-        fetchValues(self._eqval, self._constraintsEQ)
-        fetchValues(self._gtval, self._constraintsGT)
+        if values is None:
+            os.chdir(self._workDir)
+            # in sequential mode the evaluations run here
+            with self._abortOnError():
+                fetchValues(self._ofval, self._objectives)
+                fetchValues(self._eqval, self._constraintsEQ)
+                fetchValues(self._gtval, self._constraintsGT)
+            #end
+
+            # failed evaluations are not stored
+            if self._database is not None and not defaults:
+                values = np.concatenate((self._ofval,self._eqval,self._gtval))
+                self._database.setValues(self._dbKey,values)
+            #end
+        else:
+            i = self._ofval.size
+            j = i+self._eqval.size
+            self._ofval[()] = values[0:i]
+            self._eqval[()] = values[i:j]
+            self._gtval[()] = values[j:]
+        #end
 
         self._funTime += time.time()
 
@@ -227,13 +1010,31 @@ class ParallelEvalDriver(DriverBase):
         for i, obj in enumerate(self._constraintsGT):
             self._gtval[i] = (self._gtval[i] - obj.bound) * obj.scale
 
-        self._runAction(self._userPostProcessFun)
+        if not self._valuesFromDb:
+            self._runAction(self._userPostProcessFun)
 
         os.chdir(self._userDir)
         self._funReady = True
+        self._valuesReady = True
         return True
     #end
 
+    # run the value evaluations in parallel mode, in sequential
+    # mode they take place when retrieving the values
+    def _evalFunctions(self):
+        if not self._parallelEval: return
+        # configuration errors are raised regardless of the failure mode
+        self._checkTokenPools()
+
+        os.chdir(self._workDir)
+        try:
+            self._evalFunInParallel()
+        except Exception:
+            if self._failureMode == "HARD": raise
+        #end
+        os.chdir(self._userDir)
+    #end
+
     # Evaluates all gradients in parallel execution mode, otherwise
     # it only runs the user preprocessing and the execution takes place
     # when the results are read in "function.getGradient".
@@ -244,6 +1045,26 @@ class ParallelEvalDriver(DriverBase):
         # lazy evaluation
         if self._jacReady: return False
 
+        # gradients of designs that were evaluated before
+        if self._hasStoredGradients():
+            self._jacReady = True
+            self._jacEval += 1
+            return True
+        #end
+
+        # the gradient evaluations may need the outputs of the value evaluations
+        if self._valuesFromDb:
+            self._runAction(self._userPreProcessFun)
+            self._evalFunctions()
+            if not self._parallelEval:
+                os.chdir(self._workDir)
+                with self._abortOnError():
+                    for function in self._gradientFunctions(): function.getValue()
+            self._runAction(self._userPostProcessFun)
+            os.chdir(self._userDir)
+            self._valuesFromDb = False
+        #end
+
         self._runAction(self._userPreProcessGrad)
 
         os.chdir(self._workDir)
@@ -261,4 +1082,3 @@ class ParallelEvalDriver(DriverBase):
         return True
     #end
 #end
-
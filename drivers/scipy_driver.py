@@ -95,12 +95,12 @@ class ScipyDriver(ConstrainedOptimizationDriver):
 
             self._grad_f[()] = 0.0
             for obj in self._objectives:
-                self._grad_f += obj.function.getGradient(self._variableStartMask) * obj.scale
+                self._grad_f += self._getGradient(obj.function) * obj.scale
             self._grad_f /= self._varScales
 
             # keep copy of result to use as fallback on next iteration if needed
             self._old_grad_f[()] = self._grad_f
-        except:
+        except Exception:
             if self._failureMode == "HARD": raise
             self._grad_f[()] = self._old_grad_f
         #end
@@ -135,8 +135,6 @@ class ScipyDriver(ConstrainedOptimizationDriver):
 
             os.chdir(self._workDir)
 
-            mask = self._variableStartMask
-
             if idx < len(self._constraintsEQ):
                 con = self._constraintsEQ[idx]
                 f = -1.0 # for purposes of lazy evaluation equality is always active
@@ -146,14 +144,14 @@ class ScipyDriver(ConstrainedOptimizationDriver):
             #end
 
             if f < 0.0 or not self._asNeeded:
-                self._jac_g[:,idx] = con.function.getGradient(mask) * con.scale / self._varScales
+                self._jac_g[:,idx] = self._getGradient(con.function) * con.scale / self._varScales
             else:
                 self._jac_g[:,idx] = 0.0
             #end
 
             # keep reference to result to use as fallback on next iteration if needed
             self._old_jac_g[:,idx] = self._jac_g[:,idx]
-        except:
+        except Exception:
             if self._failureMode == "HARD": raise
             self._jac_g[:,idx] = self._old_jac_g[:,idx]
         #end
@@ -16,8 +16,224 @@
 #  along with FADO.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import glob
+import time
+import signal
+import select
 import shutil
+import asyncio
+import tempfile
+import statistics
 import subprocess as sp
+from variable import Parameter
+from tracing import traceSpan
+from launchers import LocalLauncher
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# ioctl request to clone (reflink) a file, Linux only (e.g. Btrfs, XFS)
+_FICLONE = 0x40049409
+
+def _reflink(src,dst):
+    if fcntl is None: raise OSError("Reflinks are not supported.")
+    with open(src,"rb") as fsrc, open(dst,"wb") as fdst:
+        fcntl.ioctl(fdst.fileno(),_FICLONE,fsrc.fileno())
+    shutil.copymode(src,dst)
+#end
+
+def _copyFileRange(src,dst):
+    with open(src,"rb") as fsrc, open(dst,"wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        while size > 0:
+            num = os.copy_file_range(fsrc.fileno(),fdst.fileno(),size)
+            if num == 0: break
+            size -= num
+        #end
+    #end
+    shutil.copymode(src,dst)
+#end
+
+_stagingFunctions = {"reflink" : _reflink, "hardlink" : os.link, "copy_file_range" : _copyFileRange,
+                     "copy" : shutil.copy, "symlink" : os.symlink}
+
+# methods tried (in order) by each staging mode
+_stagingModes = {"copy" : ("copy",), "symlink" : ("symlink",),
+                 "cow" : ("reflink","copy_file_range","copy"),
+                 "fast" : ("reflink","hardlink","copy_file_range","copy")}
+
+# stage src as dst with the first method that works, return the method used
+def _stageFile(src,dst,methods):
+    for method in methods[0:-1]:
+        try:
+            _stagingFunctions[method](src,dst)
+            return method
+        except (OSError,AttributeError):
+            if os.path.lexists(dst): os.remove(dst)
+        #end
+    #end
+    _stagingFunctions[methods[-1]](src,dst)
+    return methods[-1]
+#end
+
+
+class _Process:
+    """
+    A process of an ExternalRun, with its output files and a file descriptor to wait for it.
+    If newSession=True the process is started in its own session (process group),
+    this allows killing it along with all its children (e.g. those of mpirun).
+    Local processes are reaped with wait4 to obtain their resource usage.
+    """
+    def __init__(self,dir,newSession,launcher):
+        self.dir = dir
+        self.newSession = newSession
+        self.launcher = launcher
+        self.handle = None
+        self.pidfd = None
+        self.aborted = False
+        self.stopped = False
+        self.hasDuplicate = False
+        self.isDuplicate = False
+        self.tryNum = 0
+        self.usage = None
+        self.slot = None
+        self.startTime = time.time()
+        self.lastCheck = {}
+        self.stdout = open(os.path.join(dir,"stdout.txt"),"w")
+        self.stderr = open(os.path.join(dir,"stderr.txt"),"w")
+
+    def start(self,command,env,cores):
+        self.handle = self.launcher.start(command,self.dir,env,cores,self.newSession,
+                                          self.stdout,self.stderr)
+        self.pidfd = self.launcher.getWaitHandle(self.handle)
+    #end
+
+    async def startAsync(self,command,env,cores):
+        if hasattr(self.launcher,"startAsync"):
+            self.handle = await self.launcher.startAsync(command,self.dir,env,cores,
+                                  self.newSession,self.stdout,self.stderr)
+            # to know when it exits if its event loop is closed (see isAlive)
+            self.pidfd = self.launcher.getWaitHandle(self.handle)
+        else:
+            self.start(command,env,cores)
+    #end
+
+    async def waitAsync(self,timeout=None):
+        if isinstance(self.handle,asyncio.subprocess.Process):
+            return await asyncio.wait_for(self.handle.wait(),timeout)
+
+        # handles without a file descriptor are polled
+        if self.pidfd is None:
+            start = time.time()
+            while True:
+                step = 0.1
+                if timeout is not None:
+                    step = min(step,timeout-(time.time()-start))
+                    if step <= 0.0: raise asyncio.TimeoutError()
+                #end
+                await asyncio.sleep(step)
+                if self.handle.poll() is not None: return self.handle.returncode
+            #end
+        #end
+
+        # other handles are awaited via their file descriptor
+        loop = asyncio.get_running_loop()
+        done = asyncio.Event()
+        loop.add_reader(self.pidfd,done.set)
+        try:
+            await asyncio.wait_for(done.wait(),timeout)
+        finally:
+            loop.remove_reader(self.pidfd)
+        return self.wait()
+    #end
+
+    # reap a Popen process instead of letting it do so, to get the usage of resources
+    def _reap(self,options):
+        if not isinstance(self.handle,sp.Popen) or self.handle.returncode is not None: return
+        if not hasattr(os,"wait4"): return
+        try:
+            pid,status,usage = os.wait4(self.handle.pid,options)
+        except ChildProcessError:
+            return
+        if pid == 0: return
+        self.handle.returncode = os.waitstatus_to_exitcode(status)
+        self.usage = usage
+    #end
+
+    def poll(self):
+        self._reap(os.WNOHANG)
+        return self.handle.poll()
+
+    def wait(self,timeout=None):
+        if timeout is not None and self.pidfd is not None:
+            if not select.select([self.pidfd],[],[],timeout)[0]:
+                raise sp.TimeoutExpired("",timeout)
+            timeout = None
+        #end
+        if timeout is None: self._reap(0)
+        return self.handle.wait(timeout)
+    #end
+
+    def takeUsage(self):
+        """Return the resources used by the process (once), None if they are not known."""
+        usage = self.usage
+        if usage is None: return None
+        self.usage = None
+        return {"try" : self.tryNum, "duplicate" : self.isDuplicate,
+                "returncode" : self.handle.returncode, "elapsed" : self.getElapsedTime(),
+                "user" : usage.ru_utime, "system" : usage.ru_stime, "maxrss" : usage.ru_maxrss,
+                "inblock" : usage.ru_inblock, "outblock" : usage.ru_oublock,
+                "voluntary" : usage.ru_nvcsw, "involuntary" : usage.ru_nivcsw}
+    #end
+
+    def getReturnCode(self):
+        return self.handle.returncode
+
+    def getElapsedTime(self):
+        return time.time()-self.startTime
+
+    def getTimeLeft(self,limit):
+        if limit is None: return None
+        return max(0.0,limit-self.getElapsedTime())
+
+    def getTimeToCheck(self,monitor):
+        last = self.lastCheck.get(monitor,self.startTime)
+        return max(0.0,last+monitor.getInterval()-time.time())
+
+    def sendSignal(self,sig):
+        if self.handle.returncode is not None: return
+        try:
+            if self.newSession and self.handle.pid is not None:
+                os.killpg(self.handle.pid,sig)
+            else:
+                self.handle.send_signal(sig)
+        except ProcessLookupError:
+            pass
+    #end
+
+    def kill(self):
+        self.sendSignal(signal.SIGKILL)
+
+    def isAlive(self):
+        # asyncio processes are reaped by their event loop, which may have been closed
+        if isinstance(self.handle,asyncio.subprocess.Process):
+            if self.handle.returncode is not None: return False
+            if self.pidfd is None: return True
+            return not select.select([self.pidfd],[],[],0)[0]
+        #end
+        return self.poll() is None
+    #end
+
+    def close(self):
+        self.stdout.close()
+        self.stderr.close()
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+    #end
+#end
 
 
 class ExternalRun:
@@ -37,15 +253,44 @@ class ExternalRun:
         self._confFiles = []
         self._expectedFiles = []
         self._workDir = dir
+        self._runDir = dir
+        self._scratch = None
+        self._keepScratch = False
+        self._outputFiles = []
+        self._dependencies = []
+        self._warmPatterns = []
+        self._warmDir = None
+        self._warmSwitch = None
+        self._isWarm = False
+        self._iterCounter = None
+        self._coldIters = []
+        self._savedIters = 0
         self._command = command
-        self._symLinks = useSymLinks
+        self._dataStaging = _stagingModes[("copy","symlink")[useSymLinks]]
+        self._stagingMethods = {}
+        self._templates = {}
         self._maxTries = 1
         self._numTries = 0
         self._process = None
+        self._duplicate = None
+        self._timeout = None
+        self._stragglerFactor = None
+        self._minSamples = 3
+        self._durations = []
+        self._monitors = []
+        self._launcher = LocalLauncher()
         self._variables = set()
         self._parameters = []
-        self._stdout = None
-        self._stderr = None
+        self._cores = 1
+        self._usage = []
+        self._totalUsage = {}
+        self._tracer = None
+        self._isStaged = False
+        self._stagingTime = 0.0
+        self._env = {}
+        self._tokens = {}
+        self._cache = None
+        self._cacheKey = None
         self.finalize()
 
     def _addAbsoluteFile(self,file,flist):
@@ -78,6 +323,36 @@ class ExternalRun:
         #end
     #end
 
+    def addDependency(self,evaluation):
+        """
+        Declare that the run needs the outputs of another evaluation, in addition to the
+        dependencies drivers infer from data files in the directories of other runs.
+        """
+        self._dependencies.append(evaluation)
+
+    def getDependencies(self):
+        return self._dependencies
+
+    def setDataStaging(self,mode):
+        """
+        Set how "data" files are staged in the working subdirectory, the modes are:
+        "copy"    : Regular copies (default);
+        "symlink" : Symbolic links (same as useSymLinks=True);
+        "cow"     : Copy-on-write clones (reflinks), falling back to os.copy_file_range
+                    and then to regular copies, safe for codes that modify their inputs;
+        "fast"    : As "cow" but hard links are tried before os.copy_file_range, only
+                    suitable if the files are not modified in place.
+        The method used for each file is available via getStagingMethods().
+        """
+        if mode not in _stagingModes:
+            raise ValueError("Unknown staging mode '"+mode+"'.")
+        self._dataStaging = _stagingModes[mode]
+    #end
+
+    def getStagingMethods(self):
+        """Return a dictionary with the method used to stage each data file (by name)."""
+        return self._stagingMethods
+
     def addConfig(self,file):
         """Add a "configuration" file to the run, a mutable dependency onto which
         Parameters and Variables are written. The path ("file") is converted
@@ -94,10 +369,171 @@ class ExternalRun:
         files in the working subdirectory indicates that the run succeeded."""
         self._expectedFiles.append(os.path.join(self._workDir,file))
 
+    def addOutput(self,file):
+        """Add an output file that is used by other runs or functions but that is
+        not required for success, see setScratch."""
+        if file not in self._outputFiles: self._outputFiles.append(file)
+
+    def setScratch(self,root,keep=False):
+        """
+        Stage and execute the run in a temporary directory under "root" (e.g. tmpfs or a
+        local disk) instead of the working subdirectory, which only receives copies of the
+        expected and output files (see addOutput), and of stdout.txt and stderr.txt.
+        The scratch directory is deleted when the run is finalized, unless keep=True.
+        Drivers can set this for all runs (see DriverBase.setScratch).
+        """
+        self._scratch = os.path.abspath(root)
+        self._keepScratch = keep
+
+    def addWarmStart(self,pattern):
+        """
+        Add a pattern (glob style, e.g. "solution_adj_*.dat") for outputs that are used to
+        warm-start the run at the next design, they are saved when the run succeeds (in
+        ".fado_warmstart/dir" by default, see setWarmStartDir) and staged with the data files.
+        If none were saved the run is cold-started, see also setWarmStartSwitch.
+        """
+        self._warmPatterns.append(pattern)
+        if self._warmDir is None:
+            self.setWarmStartDir(os.path.join(".fado_warmstart",self._workDir))
+    #end
+
+    def setWarmStartDir(self,dir):
+        """Set where the warm-start files are saved between designs."""
+        self._warmDir = os.path.abspath(dir)
+
+    def setWarmStartSwitch(self,parser,cold="NO",warm="YES"):
+        """
+        Write "cold" or "warm" to the configuration files (via parser, e.g. LabelReplacer)
+        depending on whether warm-start files were staged. The environment variable
+        FADO_WARM_START is also set to 0 or 1 for runs with warm-start patterns.
+        """
+        self._warmSwitch = Parameter([cold,warm],parser)
+
+    def setIterationCounter(self,file,parser):
+        """
+        Set how to read the number of iterations done by the solver (e.g. the last value of
+        a column of the history file), to measure the iterations saved by warm-starting.
+        """
+        self._iterCounter = (file,parser)
+
+    def isWarmStarted(self):
+        """Return True if warm-start files were staged for the current run."""
+        return self._isWarm
+
+    def getSavedIterations(self):
+        """
+        Return the total number of iterations saved by warm-starting, relative to the median
+        number of iterations of cold-started runs (see setIterationCounter).
+        """
+        return self._savedIters
+
+    def getWorkDir(self):
+        return self._workDir
+
+    def getDataFiles(self):
+        return self._dataFiles
+
     def setMaxTries(self,num):
         """Sets the maximum number of times a run is re-tried should it fail."""
         self._maxTries = num
 
+    def setTimeout(self,seconds):
+        """
+        Set a wall-clock limit (in seconds) for each try of the run. Processes that exceed
+        it are killed, along with their children (the process is started in its own process
+        group), and the try counts as failed (see setMaxTries).
+        """
+        self._timeout = seconds
+
+    def addMonitor(self,monitor):
+        """
+        Add a LogMonitor to stop the process early when it converges, or to kill it
+        (the try counts as failed, see setMaxTries) when it fails.
+        """
+        self._monitors.append(monitor)
+
+    def setStragglerFactor(self,factor,minSamples=3):
+        """
+        In parallel evaluation mode, start a duplicate of the run (in "dir"_DUP) when it
+        takes longer than "factor" times the median duration of its previous successful
+        runs (once there are "minSamples" of them), the first copy to finish successfully
+        is kept and the other is killed. Not supported by the asyncio backend.
+        """
+        self._stragglerFactor = factor
+        self._minSamples = minSamples
+    #end
+
+    def setResources(self,cores=1,threadsPerRank=1):
+        """
+        Declare the number of cores used by the run (e.g. MPI ranks x threads per rank),
+        drivers use this to avoid oversubscribing the machine (see setCoreBudget).
+        OMP_NUM_THREADS (and the MKL/OpenBLAS equivalents) is set to threadsPerRank for
+        the process, and FADO_NUM_CORES to cores.
+        """
+        if cores < 1 or threadsPerRank < 1:
+            raise ValueError("The number of cores and threads must be positive.")
+        self._cores = cores
+        for name in ("OMP_NUM_THREADS","MKL_NUM_THREADS","OPENBLAS_NUM_THREADS"):
+            self._env[name] = str(threadsPerRank)
+        self._env["FADO_NUM_CORES"] = str(cores)
+    #end
+
+    def getCores(self):
+        return self._cores
+
+    def setCpuSet(self,cpus=None):
+        """
+        Bind the process to a set of CPUs (if the launcher supports it), drivers use this
+        to place concurrent runs on disjoint cores (see setCpuAffinity). The set is also
+        available to the process as FADO_CPU_LIST (e.g. for "mpirun --cpu-set"), None
+        removes the binding.
+        """
+        if cpus is None:
+            self._env.pop("FADO_CPU_LIST",None)
+        else:
+            self._env["FADO_CPU_LIST"] = ",".join(str(cpu) for cpu in sorted(cpus))
+    #end
+
+    def setTracer(self,tracer):
+        """Set the Tracer that records the staging and the processes of the run."""
+        self._tracer = tracer
+
+    def setLauncher(self,launcher):
+        """Set how the process is started, e.g. on worker daemons (see WorkerLauncher)."""
+        self._launcher = launcher
+
+    def getLauncher(self):
+        return self._launcher
+
+    def canLaunch(self):
+        """Return True if the launcher has the resources to start the process now."""
+        return self._launcher.hasCapacity(self._cores)
+
+    def getNumProcesses(self):
+        """Return the number of processes of the run, 2 if a duplicate is running."""
+        return 1+(self._duplicate is not None)
+
+    def requireTokens(self,pool,num=1):
+        """
+        Require "num" tokens from a named pool (e.g. software licenses) to start the run,
+        the pools are defined on the driver (see setTokenPool). The tokens are held
+        until the run finishes.
+        """
+        if num < 1: raise ValueError("The number of tokens must be positive.")
+        self._tokens[pool] = num
+    #end
+
+    def getTokens(self):
+        return self._tokens
+
+    def setCache(self,cache):
+        """
+        Set an EvaluationCache, the process is not started if a previous run with the
+        same inputs succeeded, the expected files are restored from the cache instead.
+        Runs without expected files (see addExpected) are not cached.
+        """
+        self._cache = cache
+
     def getParameters(self):
         return self._parameters
 
@@ -115,34 +551,481 @@ class ExternalRun:
         configuration files, and write the parameters and variables to the latter.
         """
         if self._isIni: return
+        self.stage()
+        self.launch()
+    #end
 
-        os.mkdir(self._workDir)
+    async def initializeAsync(self):
+        """Coroutine version of initialize, the process is created via asyncio."""
+        if self._isIni: return
+        self.stage()
+        await self.launchAsync()
+    #end
+
+    def stage(self,parent=None):
+        """
+        First half of initialize, create the subdirectory and stage the files without
+        starting the process. Only touches the files of this run, drivers may stage
+        several runs concurrently on other threads (see setStagingThreads), passing the
+        directory where the subdirectory is created ("parent", the current by default)
+        since they may change directory meanwhile.
+        """
+        if self._isIni or self._isStaged: return
+        if parent is None: parent = os.getcwd()
+        start = time.time()
+        self._stage(os.path.join(parent,self._makeRunDir(parent)),parent)
+        self._stagingTime = time.time()-start
+        self._isStaged = True
+        if self._tracer is not None:
+            self._tracer.addAsyncSpan("stage "+self._workDir,"stage",start,start+self._stagingTime)
+    #end
+
+    def launch(self):
+        """Second half of initialize, start the process (or restore the outputs from the cache)."""
+        if self._isIni: return
+        self.stage()
+        self._numTries = 0
+        self._usage = []
+        self._isRun = self._restoreFromCache()
+        if not self._isRun: self._createProcess()
+        self._isIni = True
+        self._isStaged = False
+    #end
+
+    async def launchAsync(self):
+        """Coroutine version of launch."""
+        if self._isIni: return
+        self.stage()
+        self._numTries = 0
+        self._usage = []
+        self._isRun = self._restoreFromCache()
+        if not self._isRun: await self._createProcessAsync()
+        self._isIni = True
+        self._isStaged = False
+    #end
+
+    def getStagingTime(self):
+        """Return the time (s) spent staging the files of the current (or last) design."""
+        return self._stagingTime
+
+    # the directory where the process runs, in scratch mode the working subdirectory
+    # is created empty, to receive the outputs
+    def _makeRunDir(self,parent):
+        if self._scratch is None:
+            self._runDir = self._workDir
+        else:
+            os.makedirs(self._scratch,exist_ok=True)
+            base = tempfile.mkdtemp("","FADO_"+os.path.basename(self._workDir)+"_",self._scratch)
+            self._runDir = os.path.join(base,os.path.basename(self._workDir))
+            os.mkdir(os.path.join(parent,self._workDir))
+        #end
+        return self._runDir
+    #end
+
+    # copy the outputs of a scratch run to the working subdirectory
+    def _copyBack(self):
+        if self._runDir == self._workDir: return
+        for file in self._relativeOutputs()+self._outputFiles+["stdout.txt","stderr.txt"]:
+            src = os.path.join(self._runDir,file)
+            if not os.path.isfile(src): continue
+            dst = os.path.join(self._workDir,file)
+            if os.path.dirname(file): os.makedirs(os.path.dirname(dst),exist_ok=True)
+            shutil.copy2(src,dst)
+        #end
+    #end
+
+    def _removeScratch(self):
+        if self._runDir == self._workDir: return
+        if not self._keepScratch:
+            shutil.rmtree(os.path.dirname(self._runDir),ignore_errors=True)
+        self._runDir = self._workDir
+    #end
+
+    # relative data files are in "parent"
+    def _stage(self,dir,parent):
+        os.mkdir(dir)
         for file in self._dataFiles:
-            target = os.path.join(self._workDir,os.path.basename(file))
-            (shutil.copy,os.symlink)[self._symLinks](os.path.abspath(file),target)
+            name = os.path.basename(file)
+            target = os.path.join(dir,name)
+            self._stagingMethods[name] = _stageFile(os.path.abspath(os.path.join(parent,file)),target,self._dataStaging)
+
+        self._stageWarmStart(dir)
 
         for file in self._confFiles:
-            target = os.path.join(self._workDir,os.path.basename(file))
-            shutil.copy(file,target)
+            target = os.path.join(dir,os.path.basename(file))
+            self._renderConfig(file,target)
+    #end
+
+    # stage the files saved by the previous successful run, they are copied (or cloned)
+    # because solvers may overwrite their restart files
+    def _stageWarmStart(self,dir):
+        if not self._warmPatterns: return
+
+        files = []
+        for pattern in self._warmPatterns:
+            files += glob.glob(os.path.join(self._warmDir,pattern))
+        for file in files:
+            _stageFile(file,os.path.join(dir,os.path.basename(file)),_stagingModes["cow"])
+
+        self._isWarm = len(files) > 0
+        self._env["FADO_WARM_START"] = str(int(self._isWarm))
+        if self._warmSwitch is not None:
+            if self._isWarm: self._warmSwitch.increment()
+            else: self._warmSwitch.decrement()
+        #end
+    #end
+
+    # save the warm-start files of a successful run, and count the iterations it took
+    def _saveWarmStart(self):
+        if not self._warmPatterns: return
+
+        files = []
+        for pattern in self._warmPatterns:
+            files += glob.glob(os.path.join(self._runDir,pattern))
+        if files:
+            if os.path.isdir(self._warmDir): shutil.rmtree(self._warmDir)
+            os.makedirs(self._warmDir)
+            for file in files:
+                _stageFile(file,os.path.join(self._warmDir,os.path.basename(file)),["hardlink","copy"])
+        #end
+
+        if self._iterCounter is None: return
+        try:
+            iters = float(self._iterCounter[1].read(os.path.join(self._runDir,self._iterCounter[0])))
+        except:
+            return
+        if not self._isWarm:
+            self._coldIters = self._coldIters[-19:]+[iters]
+        elif self._coldIters:
+            self._savedIters += max(0.0,statistics.median(self._coldIters)-iters)
+    #end
+
+    # write the parameters and variables to a configuration file in memory, and the result
+    # to the target in one go, the template with the parameters applied is kept (compiled)
+    # for as long as the file and the values of the parameters do not change
+    def _renderConfig(self,file,target):
+        objs = list(self._variables)
+        if self._warmSwitch is not None: objs.append(self._warmSwitch)
+
+        stat = os.stat(file)
+        signature = (stat.st_mtime_ns,stat.st_size,[str(par.getValue()) for par in self._parameters],objs)
+
+        if file in self._templates and self._templates[file][0] == signature:
+            lines,index = self._templates[file][1:]
+        else:
+            with open(file) as f:
+                lines = f.readlines()
             for par in self._parameters:
-                par.writeToFile(target)
-            for var in self._variables:
-                var.writeToFile(target)
+                lines = self._renderOrWrite(par,lines,target)
+            # index the lines where each variable is written, the only ones that change
+            # between iterations (None for parsers that cannot tell)
+            index = [obj.findLines(lines) for obj in objs]
+            self._templates[file] = (signature,lines,index)
+        #end
 
-        self._createProcess()
-        self._isIni = True
-        self._isRun = False
+        lines = list(lines)
+        size = len(lines)
+        for obj,rows in zip(objs,index):
+            # the index is invalid if a parser without one changed the number of lines
+            if rows is None or len(lines) != size:
+                lines = self._renderOrWrite(obj,lines,target)
+                continue
+            #end
+            newLines = obj.render([lines[i] for i in rows])
+            if newLines is None:
+                lines = self._renderOrWrite(obj,lines,target)
+                continue
+            #end
+            for i,line in zip(rows,newLines): lines[i] = line
+        #end
+
+        with open(target,"w") as f:
+            f.writelines(lines)
+        shutil.copymode(file,target)
+    #end
+
+    # parsers that cannot render in memory need to write the file
+    def _renderOrWrite(self,obj,lines,target):
+        newLines = obj.render(lines)
+        if newLines is not None: return newLines
+
+        with open(target,"w") as f:
+            f.writelines(lines)
+        obj.writeToFile(target)
+        with open(target) as f:
+            return f.readlines()
+    #end
+
+    # outputs relative to the working subdirectory
+    def _relativeOutputs(self):
+        return [os.path.relpath(file,self._workDir) for file in self._expectedFiles]
+
+    # compute the cache key of the staged run and try to restore its outputs
+    def _restoreFromCache(self):
+        self._cacheKey = None
+        # nothing could be restored for runs without expected files
+        if self._cache is None or not self._expectedFiles: return False
+
+        confFiles = [os.path.join(self._runDir,os.path.basename(file)) for file in self._confFiles]
+        paramValues = [par.getValue() for par in self._parameters]
+        self._cacheKey = self._cache.getKey(self._command,confFiles,self._dataFiles,
+                                            paramValues,self._relativeOutputs())
+
+        if not self._cache.restore(self._cacheKey,self._relativeOutputs(),self._runDir):
+            return False
+        self._copyBack()
+        self._retcode = 0
+        return True
+    #end
+
+    # set the state of a successful run
+    def _setFinished(self):
         self._numTries = 0
+        self._isRun = True
+        self._durations = self._durations[-19:]+[self._process.getElapsedTime()]
+        self._closeProcess()
+        if self._cacheKey is not None:
+            self._cache.store(self._cacheKey,self._relativeOutputs(),self._runDir)
+        self._saveWarmStart()
+        self._copyBack()
     #end
 
     def _createProcess(self):
-        self._stdout = open(os.path.join(self._workDir,"stdout.txt"),"w")
-        self._stderr = open(os.path.join(self._workDir,"stderr.txt"),"w")
+        self._closeProcess()
+        self._process = _Process(self._runDir,True,self._launcher)
+        self._process.tryNum = self._numTries
+        self._traceStart(self._process)
+        self._process.start(self._command,self._getEnvironment(),self._cores)
+    #end
+
+    async def _createProcessAsync(self):
+        self._closeProcess()
+        self._process = _Process(self._runDir,True,self._launcher)
+        self._process.tryNum = self._numTries
+        self._traceStart(self._process)
+        await self._process.startAsync(self._command,self._getEnvironment(),self._cores)
+    #end
+
+    # the environment of the process, None to inherit it unchanged
+    def _getEnvironment(self):
+        if not self._env: return None
+        env = dict(os.environ)
+        env.update(self._env)
+        return env
+    #end
+
+    # close a process and account for the resources it used
+    def _closeProcess(self,process=None):
+        if process is None: process = self._process
+        if process is None: return
+        self._traceEnd(process)
+        usage = process.takeUsage()
+        if usage is not None:
+            self._usage.append(usage)
+            for key in ("user","system","inblock","outblock","voluntary","involuntary"):
+                self._totalUsage[key] = self._totalUsage.get(key,0)+usage[key]
+            self._totalUsage["maxrss"] = max(self._totalUsage.get("maxrss",0),usage["maxrss"])
+            self._totalUsage["processes"] = self._totalUsage.get("processes",0)+1
+        #end
+        process.close()
+    #end
+
+    # processes are traced on the lowest free slot track
+    def _traceStart(self,process):
+        if self._tracer is not None: process.slot = self._tracer.acquireSlot()
+
+    def _traceEnd(self,process):
+        if process.slot is None: return
+        args = {"try" : process.tryNum, "duplicate" : process.isDuplicate}
+        if process.handle is not None: args["returncode"] = process.handle.returncode
+        self._tracer.addSpan(self._workDir,"run",process.startTime,time.time(),process.slot,args)
+        self._tracer.releaseSlot(process.slot)
+        process.slot = None
+    #end
+
+    def getResourceUsage(self,total=False):
+        """
+        Return the resources used by the processes of the current (or last) design, one
+        dict per process, with the try number, whether it was a duplicate, "returncode",
+        "elapsed" (wall time in s), "user" and "system" (CPU time in s), "maxrss" (peak
+        resident memory, in kB on Linux), "inblock" and "outblock" (block I/O operations),
+        and "voluntary" and "involuntary" (context switches). If total=True, return the
+        sums over all designs (maxrss is the maximum, "processes" the number of processes).
+        Only processes started by Popen are accounted (not asyncio or remote ones).
+        """
+        if total: return dict(self._totalUsage)
+        return [dict(usage) for usage in self._usage]
+    #end
+
+    def getWaitHandles(self):
+        """
+        Return the file descriptors that become readable when the processes of the run
+        exit, or None if the platform does not support pidfds (empty if nothing is running).
+        Drivers use them to sleep until a process finishes instead of polling.
+        """
+        if not self._isIni or self._isRun: return []
+        handles = []
+        for process in (self._process,self._duplicate):
+            if process is None: continue
+            if process.pidfd is None: return None
+            handles.append(process.pidfd)
+        #end
+        return handles
+    #end
+
+    # duration after which the run is considered a straggler
+    def getExpectedDuration(self):
+        """
+        Return the expected duration of the run (the median of its last successful runs),
+        None if it did not run yet. Drivers use it to prioritize the longest paths.
+        """
+        if not self._durations: return None
+        return statistics.median(self._durations)
+    #end
+
+    def _stragglerTime(self):
+        if self._stragglerFactor is None or len(self._durations) < self._minSamples:
+            return None
+        return self._stragglerFactor*statistics.median(self._durations)
+    #end
+
+    def getTimeToDeadline(self):
+        """
+        Return the time until the run needs attention, to enforce the timeout or to
+        start a duplicate, None if there is no deadline. Drivers use it to limit waits.
+        """
+        if not self._isIni or self._isRun: return None
+        times = [self._timeToCheck(self._process)]
+        if self._duplicate is not None:
+            times.append(self._timeToCheck(self._duplicate))
+        if not self._process.hasDuplicate and self._stragglerTime() is not None:
+            times.append(self._process.getTimeLeft(self._stragglerTime()))
+        times = [t for t in times if t is not None]
+        if not times: return None
+        return min(times)
+    #end
+
+    # time until the time limit or the monitors of a process need to be checked
+    def _timeToCheck(self,process):
+        if process.aborted: return None
+        times = []
+        if self._timeout is not None:
+            times.append(process.getTimeLeft(self._timeout))
+        if not process.stopped:
+            for monitor in self._monitors:
+                times.append(process.getTimeToCheck(monitor))
+        if not times: return None
+        return min(times)
+    #end
+
+    # enforce the time limit and apply the monitors to a running process
+    def _checkProcess(self,process):
+        if process.aborted: return
+        if process.getTimeLeft(self._timeout) == 0.0:
+            process.kill()
+            process.aborted = True
+            return
+        #end
+        if process.stopped: return
+
+        for monitor in self._monitors:
+            if process.getTimeToCheck(monitor) > 0.0: continue
+            state = monitor.check(process.dir)
+            process.lastCheck[monitor] = time.time()
+
+            if state == "FAILED":
+                process.kill()
+                process.aborted = True
+                return
+            elif state == "CONVERGED":
+                process.sendSignal(monitor.getStopSignal())
+                process.stopped = True
+                return
+            #end
+        #end
+    #end
 
-        self._process = sp.Popen(self._command,cwd=self._workDir,
-                        shell=True,stdout=self._stdout,stderr=self._stderr)
+    # wait for the process in steps to enforce the time limit and apply the monitors
+    def _waitProcess(self,timeout):
+        start = time.time()
+        while True:
+            step = self._timeToCheck(self._process)
+            if timeout is not None:
+                left = max(0.0,timeout-(time.time()-start))
+                if step is None or left < step:
+                    return self._process.wait(left)
+            #end
+            try:
+                return self._process.wait(step)
+            except sp.TimeoutExpired:
+                self._checkProcess(self._process)
+            #end
+        #end
+    #end
+
+    async def _waitProcessAsync(self,timeout):
+        start = time.time()
+        while True:
+            step = self._timeToCheck(self._process)
+            if timeout is not None:
+                left = max(0.0,timeout-(time.time()-start))
+                if step is None or left < step:
+                    return await self._process.waitAsync(left)
+            #end
+            try:
+                return await self._process.waitAsync(step)
+            except asyncio.TimeoutError:
+                self._checkProcess(self._process)
+            #end
+        #end
     #end
 
+    def isStraggler(self):
+        """Return True if a duplicate of the run should be started (see setStragglerFactor)."""
+        if not self._isIni or self._isRun or self._process.hasDuplicate: return False
+        limit = self._stragglerTime()
+        return limit is not None and self._process.getElapsedTime() > limit
+    #end
+
+    def startDuplicate(self):
+        """Start a duplicate of a straggling run, see setStragglerFactor."""
+        dir = self._runDir+"_DUP"
+        if os.path.isdir(dir): shutil.rmtree(dir)
+        with traceSpan(self._tracer,"stage "+self._workDir+" duplicate","stage"):
+            self._stage(dir,os.getcwd())
+        self._duplicate = _Process(dir,True,self._launcher)
+        self._duplicate.isDuplicate = True
+        self._duplicate.tryNum = self._numTries
+        self._traceStart(self._duplicate)
+        self._duplicate.start(self._command,self._getEnvironment(),self._cores)
+        self._process.hasDuplicate = True
+    #end
+
+    # the duplicate finished first, it replaces the original
+    def _adoptDuplicate(self):
+        self._process.kill()
+        self._process.wait()
+        self._closeProcess()
+        shutil.rmtree(self._runDir)
+        os.rename(self._duplicate.dir,self._runDir)
+        self._duplicate.dir = self._runDir
+        self._process = self._duplicate
+        self._duplicate = None
+    #end
+
+    def _discardDuplicate(self):
+        if self._duplicate is None: return
+        self._duplicate.kill()
+        self._duplicate.wait()
+        self._closeProcess(self._duplicate)
+        shutil.rmtree(self._duplicate.dir)
+        self._duplicate = None
+    #end
+
+    # check whether a process was successful
+    def _failed(self,process):
+        return process.aborted or not self._success(process.dir)
+
     def run(self,timeout=None):
         """Start the process and wait for it to finish."""
         if not self._isIni:
@@ -152,18 +1035,43 @@ class ExternalRun:
         if self._isRun:
             return self._retcode
 
-        self._retcode = self._process.wait(timeout)
+        self._retcode = self._waitProcess(timeout)
         self._numTries += 1
 
-        if not self._success():
-            self.finalize()
-            self._createProcess()
+        if self._failed(self._process):
+            self._reset()
             self._isIni = True
+            if self._numTries < self._maxTries: self._createProcess()
             return self.run(timeout)
         #end
 
-        self._numTries = 0
-        self._isRun = True
+        self._setFinished()
+        return self._retcode
+    #end
+
+    async def runAsync(self,timeout=None):
+        """Coroutine version of run, awaits the process instead of blocking."""
+        if not self._isIni:
+            raise RuntimeError("Run was not initialized.")
+        if self._numTries == self._maxTries:
+            raise RuntimeError("Run failed.")
+        if self._isRun:
+            return self._retcode
+
+        while True:
+            self._retcode = await self._waitProcessAsync(timeout)
+            self._numTries += 1
+
+            if not self._failed(self._process): break
+            if self._numTries == self._maxTries:
+                raise RuntimeError("Run failed.")
+
+            self._reset()
+            await self._createProcessAsync()
+            self._isIni = True
+        #end
+
+        self._setFinished()
         return self._retcode
     #end
 
@@ -176,24 +1084,85 @@ class ExternalRun:
         if self._isRun:
             return self._retcode
 
+        # a duplicate that finishes successfully replaces the original
+        if self._duplicate is not None and self._duplicate.poll() is not None:
+            if self._failed(self._duplicate):
+                self._discardDuplicate()
+            else:
+                self._adoptDuplicate()
+                self._retcode = self._process.getReturnCode()
+                self._setFinished()
+                return self._retcode
+            #end
+        #end
+
+        self._checkProcess(self._process)
+        if self._duplicate is not None:
+            self._checkProcess(self._duplicate)
+
         if self._process.poll() is not None:
+            self._discardDuplicate()
             self._numTries += 1
 
-            if not self._success():
-                self.finalize()
-                self._createProcess()
+            if self._failed(self._process):
+                self._reset()
                 self._isIni = True
+                if self._numTries < self._maxTries: self._createProcess()
                 return self.poll()
             #end
 
-            self._numTries = 0
-            self._retcode = self._process.returncode
-            self._isRun = True
+            self._retcode = self._process.getReturnCode()
+            self._setFinished()
         #end
 
         return self._retcode
     #end
 
+    def abort(self,grace=0.0):
+        """
+        Stop the processes of the run if they are running, the run is then considered
+        failed (without retries) until it is finalized. See abortRuns for "grace".
+        """
+        ExternalRun.abortRuns([self],grace)
+    #end
+
+    @staticmethod
+    def abortRuns(runs,grace=0.0):
+        """
+        Abort several runs at once, drivers use this to stop the runs in flight when one
+        fails, when the design changes, or at exit. SIGTERM is sent to the process group
+        of each process (i.e. including its children), and SIGKILL to those still alive
+        after "grace" seconds. The stdout and stderr of the processes are closed.
+        """
+        # runs that failed for good were already stopped
+        runs = [run for run in runs if run._isIni and not run._isRun and run._numTries < run._maxTries]
+        processes = []
+        for run in runs:
+            processes += [p for p in (run._process,run._duplicate) if p is not None and p.isAlive()]
+
+        for process in processes: process.sendSignal(signal.SIGTERM)
+        deadline = time.time()+grace
+        while processes and time.time() < deadline:
+            # sleep until one exits if all can be waited on
+            fds = [process.pidfd for process in processes if process.pidfd is not None]
+            step = deadline-time.time()
+            if len(fds) < len(processes): step = min(step,0.05)
+            if fds: select.select(fds,[],[],max(step,0.0))
+            else: time.sleep(max(step,0.0))
+            processes = [process for process in processes if process.isAlive()]
+        #end
+        for process in processes:
+            process.kill()
+            if not isinstance(process.handle,asyncio.subprocess.Process): process.wait()
+        #end
+
+        for run in runs:
+            run._numTries = run._maxTries
+            run._closeProcess()
+            if run._duplicate is not None: run._closeProcess(run._duplicate)
+        #end
+    #end
+
     def isIni(self):
         """Return True if the run was initialized."""
         return self._isIni
@@ -204,20 +1173,70 @@ class ExternalRun:
 
     def finalize(self):
         """Reset "lazy" flags, close the stdout and stderr of the process."""
-        try:
-            self._stdout.close()
-            self._stderr.close()
-        except:
-            pass
+        self._reset()
+        self._removeScratch()
+
+    def _reset(self):
+        self._closeProcess()
+        self._discardDuplicate()
         self._isIni = False
+        self._isStaged = False
         self._isRun = False
         self._retcode = -100
     #end
 
     # check whether expected files were created
-    def _success(self):
-        for file in self._expectedFiles:
-            if not os.path.isfile(file): return False
+    def _success(self,dir=None):
+        if dir is None: dir = self._runDir
+        for file in self._relativeOutputs():
+            if not os.path.isfile(os.path.join(dir,file)): return False
         return True
     #end
 #end
+
+
+class LogMonitor:
+    """
+    Watches a file written by an ExternalRun while its process is running, to stop the
+    process as soon as it converges, or to kill it (and retry) as soon as it fails.
+
+    Parameters
+    ----------
+    file       : The file to watch, relative to the directory of the run (e.g. "stdout.txt").
+    parser     : Object used to read the file, e.g. a TableReader or LabeledTableReader.
+    converged  : Function of the data read by the parser, if it returns True the process is stopped.
+    failed     : Function of the data, if it returns True the process is killed.
+    interval   : Minimum time (in seconds) between checks of the file.
+    stopSignal : Signal sent to stop converged processes (they may handle it to write outputs).
+
+    Example
+    -------
+    >>> LogMonitor("history.csv", LabeledTableReader('"rms[Rho]"'), lambda r: r < -10, math.isnan)
+    """
+    def __init__(self,file,parser,converged=None,failed=None,interval=5.0,stopSignal=signal.SIGTERM):
+        self._file = file
+        self._parser = parser
+        self._converged = converged
+        self._failed = failed
+        self._interval = interval
+        self._stopSignal = stopSignal
+
+    def getInterval(self):
+        return self._interval
+
+    def getStopSignal(self):
+        return self._stopSignal
+
+    def check(self,dir):
+        """Return "CONVERGED", "FAILED", or None, for the process running in "dir"."""
+        try:
+            data = self._parser.read(os.path.join(dir,self._file))
+        except:
+            # the file may not exist yet, or its last line may be incomplete
+            return None
+
+        if self._failed is not None and self._failed(data): return "FAILED"
+        if self._converged is not None and self._converged(data): return "CONVERGED"
+        return None
+    #end
+#end
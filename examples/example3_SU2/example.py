@@ -59,6 +59,7 @@ geometry.addParameter(beta)
 
 # horizontal load case
 hload_dir = ExternalRun("HLOAD","SU2_CFD -t 2 settings.cfg",True)
+hload_dir.setResources(2,2)
 hload_dir.addConfig("settings.cfg")
 hload_dir.addConfig("element_properties.dat")
 hload_dir.addData("DEFORM/mesh_def.su2")
@@ -69,6 +70,7 @@ hload_dir.addParameter(beta)
 
 # vertical load case
 vload_dir = ExternalRun("VLOAD","SU2_CFD -t 2 settings.cfg",True)
+vload_dir.setResources(2,2)
 vload_dir.addConfig("settings.cfg")
 vload_dir.addConfig("element_properties.dat")
 vload_dir.addData("DEFORM/mesh_def.su2")
@@ -83,6 +85,7 @@ adj_command = "mpirun -n 2 --bind-to none SU2_CFD_AD settings.cfg &&\
 
 # volume fraction and its derivatives
 volume = ExternalRun("VOLUME",adj_command.replace("FUN","volfrac"),True)
+volume.setResources(2)
 volume.addConfig("settings.cfg")
 volume.addConfig("element_properties.dat")
 volume.addData("DEFORM/mesh_def.su2")
@@ -98,6 +101,7 @@ volume.addParameter(load_vertical)
 
 # adjoints of the horizontal load
 hload_adj = ExternalRun("HLOAD_ADJ",adj_command.replace("FUN","refnode"),True)
+hload_adj.setResources(2)
 hload_adj.addConfig("settings.cfg")
 hload_adj.addConfig("element_properties.dat")
 hload_adj.addData("DEFORM/mesh_def.su2")
@@ -110,6 +114,7 @@ hload_adj.addParameter(beta)
 
 # adjoints of the vertical load
 vload_adj = ExternalRun("VLOAD_ADJ",adj_command.replace("FUN","refnode"),True)
+vload_adj.setResources(2)
 vload_adj.addConfig("settings.cfg")
 vload_adj.addConfig("element_properties.dat")
 vload_adj.addData("DEFORM/mesh_def.su2")
@@ -156,6 +161,7 @@ driver.addUpperBound(vol_total,4800,2e-4)
 driver.setWorkingDirectory("currentDesign")
 driver.preprocessVariables()
 driver.setEvaluationMode(True,0.1)
+driver.setCoreBudget()
 driver.setStorageMode(True)
 
 log = open("log.txt","w",1)
@@ -0,0 +1,93 @@
+# A fake batch scheduler that runs job arrays on the local machine, to test
+# BatchLauncher without a cluster, the tasks start immediately in the background.
+#
+# Usage (the tasks get their index via SLURM_ARRAY_TASK_ID):
+#   python fake_scheduler.py submit FIRST-LAST SCRIPT  -> prints the job id
+#   python fake_scheduler.py status JOB                -> prints the active tasks
+#   python fake_scheduler.py cancel JOB INDEX [SIGNAL] -> signals a task (default KILL)
+#
+# With FADO:
+#   sched = "python /path/to/fake_scheduler.py "
+#   launcher = BatchLauncher(sched+"submit 0-{last} {script}", sched+"status {job}",
+#                            sched+"cancel {job} {index} {signal}")
+#   evaluation.setLauncher(launcher)
+
+import os
+import sys
+import signal
+import tempfile
+import subprocess as sp
+
+stateDir = os.path.join(tempfile.gettempdir(),"fado_fake_scheduler_%d" % os.getuid())
+
+
+def submit(indices,script):
+    os.makedirs(stateDir,exist_ok=True)
+
+    # the job id is the first number that is not taken
+    job = 1
+    while True:
+        try:
+            os.mkdir(os.path.join(stateDir,str(job)))
+            break
+        except FileExistsError:
+            job += 1
+    #end
+
+    first,last = map(int,indices.split("-"))
+    for index in range(first,last+1):
+        env = dict(os.environ)
+        env["SLURM_ARRAY_TASK_ID"] = str(index)
+        task = sp.Popen([os.path.abspath(script)],env=env,start_new_session=True,
+                        stdout=sp.DEVNULL,stderr=sp.DEVNULL)
+        with open(os.path.join(stateDir,str(job),str(index)),"w") as f:
+            f.write(str(task.pid))
+    #end
+    print(job)
+#end
+
+
+def _tasks(job):
+    tasks = {}
+    dir = os.path.join(stateDir,job)
+    for index in os.listdir(dir):
+        with open(os.path.join(dir,index)) as f:
+            pid = int(f.read())
+        if _isAlive(pid): tasks[index] = pid
+    #end
+    return tasks
+#end
+
+
+# the tasks are orphans, they may remain as zombies for a while after they exit
+def _isAlive(pid):
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            return f.read().rsplit(")",1)[1].split()[0] != "Z"
+    except OSError:
+        pass
+    try:
+        os.kill(pid,0)
+        return True
+    except ProcessLookupError:
+        return False
+#end
+
+
+def status(job):
+    for index in sorted(_tasks(job),key=int):
+        print(job+"_"+index+" RUNNING")
+
+
+def cancel(job,index,name="KILL"):
+    pid = _tasks(job).get(index)
+    if pid is not None:
+        os.killpg(pid,getattr(signal,"SIG"+name))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        sys.exit("usage: fake_scheduler.py submit|status|cancel ...")
+
+    command = {"submit" : submit, "status" : status, "cancel" : cancel}[sys.argv[1]]
+    command(*sys.argv[2:])
@@ -15,8 +15,11 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with FADO.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
+import time
 import numpy as np
 import abc
+from tracing import traceSpan
 
 
 class FunctionBase(abc.ABC):
@@ -25,6 +28,7 @@ class FunctionBase(abc.ABC):
         self._name = name
         # inputs
         self._variables = []
+        self._tracer = None
 
     def getName(self,maxLen=0):
         name = self._name
@@ -35,6 +39,10 @@ class FunctionBase(abc.ABC):
     def getVariables(self):
         return self._variables
 
+    def setTracer(self,tracer):
+        """Set the Tracer that records the time spent reading results (see Driver.setTracer)."""
+        self._tracer = tracer
+
     @abc.abstractmethod
     def getValue(self):
         return NotImplemented
@@ -57,6 +65,12 @@ class FunctionBase(abc.ABC):
 
     def getGradientEvalChain(self):
         return []
+
+    def getOutputFiles(self):
+        return []
+
+    def prefetch(self,executor):
+        pass
 #end
 
 
@@ -94,6 +108,10 @@ class Function(FunctionBase):
         # default value when evaluation fails
         self._defaultValue = None
 
+        # results read in the background (see prefetch)
+        self._valueCache = None
+        self._gradCache = {}
+
     def addInputVariable(self,variable,gradFile,gradParser):
         """
         Attach a variable object to the function.
@@ -141,7 +159,9 @@ class Function(FunctionBase):
                 self._sequentialEval(self._funEval)
                 break
         #end
-        return self._outParser.read(self._outFile)
+        if self._valueCache is not None: return self._valueCache.result()
+        with traceSpan(self._tracer,"read "+self._name,"parse"):
+            return self._outParser.read(self._outFile)
 
     def getGradient(self,mask=None):
         """
@@ -173,8 +193,13 @@ class Function(FunctionBase):
         # populate gradient vector
         gradient = np.ndarray((size,))
         idx = 0
-        for var,file,parser in zip(self._variables,self._gradFiles,self._gradParse):
-            grad = parser.read(file)
+        for i,(var,file,parser) in enumerate(zip(self._variables,self._gradFiles,self._gradParse)):
+            if i in self._gradCache:
+                grad = self._gradCache[i].result()
+            else:
+                with traceSpan(self._tracer,"read "+self._name+" gradient","parse"):
+                    grad = parser.read(file)
+            #end
             if var.getSize() == 1:
                 try: grad = sum(grad)
                 except: pass
@@ -193,6 +218,49 @@ class Function(FunctionBase):
         return gradient
     #end
 
+    def prefetch(self,executor):
+        """
+        Start reading the output and gradient files whose evaluation steps finished on
+        "executor" (e.g. a ThreadPoolExecutor), getValue and getGradient then return these
+        results. A file is ready when the step in whose directory it is (or the last step
+        of the chain) has run. Drivers call this as evaluations complete, the results are
+        discarded when the chains are reset.
+        """
+        if self._valueCache is None and self._isProduced(self._outFile,self._funEval):
+            self._valueCache = self._submitRead(executor,self._outParser,self._outFile,"")
+
+        for i,(file,parser) in enumerate(zip(self._gradFiles,self._gradParse)):
+            if i not in self._gradCache and self._isProduced(file,self._gradEval):
+                self._gradCache[i] = self._submitRead(executor,parser,file," gradient")
+        #end
+    #end
+
+    # whether the evaluation step that writes the file has run
+    def _isProduced(self,file,evals):
+        evals = evals or self._funEval
+        if not evals: return False
+        producer = evals[-1]
+        path = os.path.normpath(file)
+        for evl in evals:
+            if path.startswith(os.path.normpath(evl.getWorkDir())+os.sep): producer = evl
+        return producer.isRun()
+    #end
+
+    def _submitRead(self,executor,parser,file,suffix):
+        # the path is resolved now, the driver may change directory while reading
+        file = os.path.abspath(file)
+        name = "read "+self._name+suffix
+        tracer = self._tracer
+        def _read():
+            start = time.time()
+            try:
+                return parser.read(file)
+            finally:
+                if tracer is not None: tracer.addAsyncSpan(name,"parse",start,time.time())
+        #end
+        return executor.submit(_read)
+    #end
+
     def _sequentialEval(self,evals):
         for evl in evals:
             evl.initialize()
@@ -201,9 +269,13 @@ class Function(FunctionBase):
     #end
 
     def resetValueEvalChain(self): 
+        if self._valueCache is not None: self._valueCache.cancel()
+        self._valueCache = None
         self._resetEvals(self._funEval)
 
     def resetGradientEvalChain(self):
+        for future in self._gradCache.values(): future.cancel()
+        self._gradCache = {}
         self._resetEvals(self._gradEval)
 
     def _resetEvals(self,evals):
@@ -218,6 +290,10 @@ class Function(FunctionBase):
     def getGradientEvalChain(self):
         return self._gradEval
 
+    def getOutputFiles(self):
+        """Return the files from which the value and the gradient are read."""
+        return [self._outFile]+self._gradFiles
+
     def hasDefaultValue(self):
         return self._defaultValue is not None
 
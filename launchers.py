@@ -0,0 +1,412 @@
+#  Copyright 2019-2020, Pedro Gomes.
+#
+#  This file is part of FADO.
+#
+#  FADO is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  FADO is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with FADO.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import shlex
+import signal
+import select
+import socket
+import asyncio
+import tempfile
+import subprocess as sp
+from worker import sendMessage, receiveMessage, listFiles
+
+
+# function that binds a child process to the CPUs listed in its environment (if any)
+def _cpuBinding(env):
+    if env is None or "FADO_CPU_LIST" not in env: return None
+    if not hasattr(os,"sched_setaffinity"): return None
+    cpus = [int(cpu) for cpu in env["FADO_CPU_LIST"].split(",")]
+    return lambda: os.sched_setaffinity(0,cpus)
+#end
+
+
+class LocalLauncher:
+    """
+    Starts the processes of ExternalRun's on the local machine, this is the default.
+    Launchers start processes (see start) and return Popen-like handles for them.
+    Processes whose environment defines FADO_CPU_LIST (e.g. "0,1,2,3") are bound to
+    those CPUs (see ParallelEvalDriver.setCpuAffinity).
+    """
+    def hasCapacity(self,cores):
+        """Return True if a process that requires "cores" can be started now."""
+        return True
+
+    def isLocal(self):
+        """Return True if the processes run on this machine."""
+        return True
+
+    def start(self,command,dir,env,cores,newSession,stdout,stderr):
+        """Start "command" in "dir" and return a handle (with the interface of Popen)."""
+        return sp.Popen(command,cwd=dir,shell=True,stdout=stdout,stderr=stderr,
+                        env=env,start_new_session=newSession,preexec_fn=_cpuBinding(env))
+
+    async def startAsync(self,command,dir,env,cores,newSession,stdout,stderr):
+        """Coroutine version of start, returns an asyncio process."""
+        return await asyncio.create_subprocess_shell(command,cwd=dir,stdout=stdout,
+                      stderr=stderr,env=env,start_new_session=newSession,
+                      preexec_fn=_cpuBinding(env))
+
+    def getWaitHandle(self,handle):
+        """
+        Return a file descriptor (owned by the caller) that becomes readable when the
+        process of "handle" exits, or None if that is not possible.
+        """
+        # the pidfd is obtained before the process can be reaped (and its pid reused)
+        try:
+            return os.pidfd_open(handle.pid)
+        except (AttributeError,OSError):
+            return None
+    #end
+
+    def flush(self):
+        """Start the processes that were deferred, drivers call this after each scheduling pass."""
+        pass
+#end
+
+
+class _RemoteProcess:
+    """
+    Popen-like handle of a process running on a worker daemon.
+    The process has no local pid, signals are sent to its process group on the worker.
+    """
+    def __init__(self,launcher,worker,sock,dir,cores):
+        self.pid = None
+        self.returncode = None
+        self._launcher = launcher
+        self._worker = worker
+        self._sock = sock
+        self._dir = dir
+        self._cores = cores
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    # receive the return code and the output files
+    def _receive(self):
+        try:
+            self.returncode = receiveMessage(self._sock,self._dir)["returncode"]
+        except (OSError,ValueError,KeyError):
+            # the worker was lost, the outputs will be missing and the run will fail
+            self.returncode = -signal.SIGKILL
+        finally:
+            self._sock.close()
+            self._launcher._release(self._worker,self._cores)
+        #end
+    #end
+
+    def poll(self):
+        if self.returncode is None and select.select([self._sock],[],[],0)[0]:
+            self._receive()
+        return self.returncode
+    #end
+
+    def wait(self,timeout=None):
+        if self.returncode is None:
+            if not select.select([self._sock],[],[],timeout)[0]:
+                raise sp.TimeoutExpired("",timeout)
+            self._receive()
+        #end
+        return self.returncode
+    #end
+
+    def send_signal(self,sig):
+        if self.returncode is not None: return
+        try:
+            sendMessage(self._sock,{"signal" : int(sig)})
+        except OSError:
+            pass
+    #end
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+#end
+
+
+class WorkerLauncher:
+    """
+    Starts the processes of ExternalRun's on a pool of worker daemons (see WorkerDaemon),
+    which may be on other machines. The contents of the run directory are sent to the
+    worker, and the files created or modified by the process are sent back when it exits.
+    Processes are placed on the worker with most free cores, drivers only start them
+    when some worker has enough free cores (see ExternalRun.setResources).
+    Log monitors only see the output files after the process exits.
+    """
+    def __init__(self):
+        self._workers = []
+
+    def addWorker(self,host,port,cores=1):
+        """Add a worker daemon listening on host:port that can run processes on "cores" cores."""
+        self._workers.append({"address" : (host,port), "cores" : cores, "used" : 0})
+
+    def hasCapacity(self,cores):
+        # otherwise the drivers would wait forever for capacity
+        if not self._workers: raise RuntimeError("WorkerLauncher has no workers (see addWorker).")
+        for worker in self._workers:
+            if worker["cores"]-worker["used"] >= min(cores,worker["cores"]): return True
+        return False
+    #end
+
+    def isLocal(self):
+        return False
+
+    def start(self,command,dir,env,cores,newSession,stdout,stderr):
+        free = [w for w in self._workers if w["cores"]-w["used"] >= min(cores,w["cores"])]
+        if not free: raise RuntimeError("No worker has enough free cores.")
+        worker = max(free,key=lambda w: w["cores"]-w["used"])
+
+        # the outputs of the process may have been open for writing
+        stdout.flush()
+        stderr.flush()
+
+        # only the variables set by FADO are sent, the rest come from the worker
+        if env is None: env = {}
+        env = dict((k,v) for k,v in env.items() if os.environ.get(k) != v)
+
+        sock = socket.create_connection(worker["address"])
+        dir = os.path.abspath(dir)
+        sendMessage(sock,{"command" : command, "env" : env},dir,listFiles(dir))
+
+        worker["used"] += cores
+        return _RemoteProcess(self,worker,sock,dir,cores)
+    #end
+
+    def getWaitHandle(self,handle):
+        return os.dup(handle.fileno())
+
+    def flush(self):
+        pass
+
+    def _release(self,worker,cores):
+        worker["used"] -= cores
+#end
+
+
+# written by the job script when a process exits, contains the return code
+_RETCODE_FILE = ".fado_retcode"
+
+
+class _JobArray:
+    """A job array submitted by a BatchLauncher, with its backed-off status polling."""
+    def __init__(self,launcher,jobId,script,size):
+        self.jobId = jobId
+        self._launcher = launcher
+        self._script = script
+        self._numActive = size
+        self._active = True
+        self._interval = launcher._interval[0]
+        self._nextCheck = time.time()+self._interval
+
+    def isActive(self):
+        if not self._active or self._launcher._status is None: return self._active
+        if time.time() < self._nextCheck: return True
+
+        out = sp.run(self._launcher._status.format(job=self.jobId),shell=True,
+                     stdout=sp.PIPE,stderr=sp.DEVNULL,universal_newlines=True)
+        self._active = out.returncode == 0 and out.stdout.strip() != ""
+
+        self._interval = min(2*self._interval,self._launcher._interval[1])
+        self._nextCheck = time.time()+self._interval
+        return self._active
+    #end
+
+    # restart the backoff, e.g. after a task is cancelled
+    def checkSoon(self):
+        self._interval = self._launcher._interval[0]
+        self._nextCheck = min(self._nextCheck,time.time()+self._interval)
+
+    # the script is removed when all the tasks are accounted for
+    def taskFinished(self):
+        self._numActive -= 1
+        if self._numActive == 0 and os.path.isfile(self._script):
+            os.remove(self._script)
+    #end
+#end
+
+
+class _BatchTask:
+    """Popen-like handle of a task of a job array, see BatchLauncher."""
+    def __init__(self,launcher,command,dir,env):
+        self.pid = None
+        self.returncode = None
+        self.command = command
+        self.dir = dir
+        self.env = env
+        self.array = None
+        self.index = None
+        self._launcher = launcher
+
+    def _readReturnCode(self):
+        try:
+            with open(os.path.join(self.dir,_RETCODE_FILE)) as f:
+                return int(f.read())
+        except (OSError,ValueError):
+            return None
+    #end
+
+    def _setReturnCode(self,retcode):
+        self.returncode = retcode
+        self.array.taskFinished()
+
+    def poll(self):
+        if self.returncode is not None: return self.returncode
+        if self.array is None: self._launcher.flush()
+
+        retcode = self._readReturnCode()
+        if retcode is None and not self.array.isActive():
+            # the file may have been written after it was first checked
+            retcode = self._readReturnCode()
+            # otherwise the task was cancelled or killed by the scheduler
+            if retcode is None: retcode = -signal.SIGKILL
+        #end
+        if retcode is not None: self._setReturnCode(retcode)
+
+        return self.returncode
+    #end
+
+    def wait(self,timeout=None):
+        start = time.time()
+        while self.poll() is None:
+            step = self._launcher._interval[0]
+            if timeout is not None:
+                left = timeout-(time.time()-start)
+                if left <= 0.0: raise sp.TimeoutExpired(self.command,timeout)
+                step = min(step,left)
+            #end
+            time.sleep(step)
+        #end
+        return self.returncode
+    #end
+
+    def send_signal(self,sig):
+        if self.returncode is not None: return
+        if self.array is None:
+            # never submitted
+            self._launcher._pending.remove(self)
+            self.returncode = -sig
+            return
+        #end
+        cancel = self._launcher._cancel.format(job=self.array.jobId,index=self.index,
+                                               signal=signal.Signals(sig).name[3:])
+        sp.run(cancel,shell=True,stdout=sp.DEVNULL,stderr=sp.DEVNULL)
+        self.array.checkSoon()
+    #end
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+#end
+
+
+class BatchLauncher:
+    """
+    Submits the processes of ExternalRun's to a batch scheduler (e.g. SLURM or PBS), the
+    processes started in the same scheduling pass of a driver are bundled into one job array.
+    Completion is detected by a file written by the job script, and via the status command
+    (polled with exponential backoff) for tasks that are killed by the scheduler.
+    The run directories must be on a file system that is shared with the compute nodes.
+    Note that time limits (ExternalRun.setTimeout) include the time spent in the queue.
+
+    Parameters
+    ----------
+    submit    : Command to submit a job array, with fields {script}, {size}, and {last}
+                (index), it must print the job id (as the last word, e.g. sbatch --parsable).
+    status    : Command that prints something while the array {job} is queued or running.
+                If None, completion is only detected via the file written by the job script.
+    cancel    : Command to cancel (or send a {signal} name to) task {index} of array {job}.
+    indexVar  : Environment variable with the index of the task in the array.
+    interval  : Tuple (min,max) for the wait between status checks (seconds).
+    scriptDir : Where to write the job scripts, by default the current directory.
+
+    Example
+    -------
+    >>> BatchLauncher("sbatch --parsable --array=0-{last} {script}", "squeue -h -j {job}",
+                      "scancel --signal={signal} {job}_{index}")
+    """
+    def __init__(self,submit,status,cancel,indexVar="SLURM_ARRAY_TASK_ID",interval=(1.0,60.0),
+                 scriptDir=None):
+        self._submit = submit
+        self._status = status
+        self._cancel = cancel
+        self._indexVar = indexVar
+        self._interval = interval
+        self._scriptDir = scriptDir
+        self._pending = []
+
+    def hasCapacity(self,cores):
+        return True
+
+    def isLocal(self):
+        return False
+
+    def start(self,command,dir,env,cores,newSession,stdout,stderr):
+        # only the variables set by FADO are exported, the rest come from the job environment
+        if env is None: env = {}
+        env = dict((k,v) for k,v in env.items() if os.environ.get(k) != v)
+
+        dir = os.path.abspath(dir)
+        if os.path.isfile(os.path.join(dir,_RETCODE_FILE)):
+            os.remove(os.path.join(dir,_RETCODE_FILE))
+
+        task = _BatchTask(self,command,dir,env)
+        self._pending.append(task)
+        return task
+    #end
+
+    def getWaitHandle(self,handle):
+        return None
+
+    def flush(self):
+        """Submit the pending processes as one job array."""
+        if not self._pending: return
+        tasks = list(self._pending)
+
+        lines = ["#!/bin/sh","case \"$"+self._indexVar+"\" in"]
+        for index,task in enumerate(tasks):
+            lines.append("%d)" % index)
+            lines.append("  cd "+shlex.quote(task.dir)+" || exit 1")
+            for key,value in task.env.items():
+                lines.append("  export "+key+"="+shlex.quote(value))
+            lines.append("  sh -c "+shlex.quote(task.command)+" > stdout.txt 2> stderr.txt")
+            lines.append("  echo $? > "+_RETCODE_FILE+".tmp && mv "+_RETCODE_FILE+".tmp "+_RETCODE_FILE)
+            lines.append("  ;;")
+        #end
+        lines.append("esac")
+
+        fd,script = tempfile.mkstemp(".sh","FADO_ARRAY_",self._scriptDir or os.getcwd())
+        with os.fdopen(fd,"w") as f:
+            f.write("\n".join(lines)+"\n")
+        os.chmod(script,0o755)
+
+        submit = self._submit.format(script=script,size=len(tasks),last=len(tasks)-1)
+        out = sp.run(submit,shell=True,stdout=sp.PIPE,stderr=sp.PIPE,universal_newlines=True)
+        if out.returncode != 0 or not out.stdout.split():
+            # the tasks fail instead of waiting for a job that does not exist
+            for task in tasks: task.returncode = -signal.SIGKILL
+            self._pending = []
+            os.remove(script)
+            raise RuntimeError("Job submission failed: "+out.stderr.strip())
+        #end
+        self._pending = []
+
+        array = _JobArray(self,out.stdout.split()[-1].split(";")[0],script,len(tasks))
+        for index,task in enumerate(tasks):
+            task.array = array
+            task.index = index
+        #end
+    #end
+#end
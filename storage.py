@@ -0,0 +1,452 @@
+#  Copyright 2019-2020, Pedro Gomes.
+#
+#  This file is part of FADO.
+#
+#  FADO is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  FADO is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with FADO.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import queue
+import shutil
+import fnmatch
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+
+
+def _hashContents(file):
+    h = hashlib.blake2b(digest_size=20)
+    with open(file,"rb") as f:
+        for chunk in iter(lambda: f.read(1<<20),b""):
+            h.update(chunk)
+    return h.hexdigest()
+#end
+
+
+class EvaluationCache:
+    """
+    Content-addressed store of the outputs of ExternalRun's.
+    The key of a run is a hash of its command, of the rendered configuration files,
+    of the contents of the data files, and of the values of its parameters.
+    When a run with the same key was successful before, its expected files (see
+    ExternalRun.addExpected) are restored from the cache instead of starting the
+    process, therefore every output needed by other runs should be "expected".
+
+    Parameters
+    ----------
+    dir : Directory where the outputs are stored (created if it does not exist).
+
+    See also
+    --------
+    ExternalRun.setCache, DriverBase.setEvaluationCache
+    """
+    def __init__(self,dir):
+        self._dir = os.path.abspath(dir)
+        if not os.path.isdir(self._dir): os.makedirs(self._dir)
+        # hashes of files that did not change (e.g. large meshes) are not recomputed
+        self._fileHashes = {}
+        self._hits = 0
+        self._misses = 0
+
+    def getHits(self):
+        """Return the number of runs restored from the cache."""
+        return self._hits
+
+    def getMisses(self):
+        """Return the number of runs that were not found in the cache."""
+        return self._misses
+
+    def hashFile(self,file):
+        """Return the content hash of a file."""
+        stat = os.stat(file)
+        sig = (os.path.realpath(file),stat.st_size,stat.st_mtime_ns,stat.st_ino)
+        if sig not in self._fileHashes:
+            self._fileHashes[sig] = _hashContents(file)
+        return self._fileHashes[sig]
+    #end
+
+    def getKey(self,command,confFiles,dataFiles,paramValues,outputs):
+        """
+        Return the key of a run, a hash of its command, rendered configuration files,
+        data files, parameter values, and names of the expected outputs.
+        """
+        h = hashlib.blake2b(digest_size=20)
+        h.update(command.encode())
+        for file in confFiles+dataFiles:
+            h.update(os.path.basename(file).encode())
+            h.update(self.hashFile(file).encode())
+        for value in paramValues:
+            h.update(str(value).encode())
+        for file in outputs:
+            h.update(file.encode())
+        return h.hexdigest()
+    #end
+
+    def restore(self,key,outputs,dir):
+        """
+        Copy the outputs (paths relative to dir) stored for key into dir,
+        returns False if the key is not in the cache.
+        """
+        src = os.path.join(self._dir,key)
+        for file in outputs:
+            if not os.path.isfile(os.path.join(src,file)):
+                self._misses += 1
+                return False
+        #end
+        for file in outputs:
+            target = os.path.join(dir,file)
+            if os.path.dirname(file): os.makedirs(os.path.dirname(target),exist_ok=True)
+            shutil.copy(os.path.join(src,file),target)
+        #end
+        self._hits += 1
+        return True
+    #end
+
+    def store(self,key,outputs,dir):
+        """Store the outputs (paths relative to dir) of a successful run under key."""
+        target = os.path.join(self._dir,key)
+        if os.path.isdir(target): return
+
+        # copy to a temporary location first so that partial entries are never visible
+        tmp = target+".tmp"+str(os.getpid())
+        for file in outputs:
+            dst = os.path.join(tmp,file)
+            os.makedirs(os.path.dirname(dst),exist_ok=True)
+            shutil.copy(os.path.join(dir,file),dst)
+        #end
+        try:
+            os.rename(tmp,target)
+        except OSError:
+            shutil.rmtree(tmp) # another process stored the same run
+    #end
+#end
+
+
+class EvaluationDatabase:
+    """
+    Persistent (SQLite) store of function values and gradients, keyed by a hash of the
+    design vector and of the values of the parameters. Drivers consult the database
+    before evaluating functions, a restarted optimization that replays the same
+    iterates gets the results up to the point where it stopped without running anything.
+
+    Parameters
+    ----------
+    file : Path to the database file (created if it does not exist).
+
+    See also
+    --------
+    DriverBase.setDatabase
+    """
+    def __init__(self,file):
+        self._connection = sqlite3.connect(file)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS funval "+
+                                 "(key TEXT PRIMARY KEY, data BLOB)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS gradient "+
+                                 "(key TEXT, name TEXT, data BLOB, PRIMARY KEY (key, name))")
+        self._connection.commit()
+    #end
+
+    def getKey(self,x,paramValues):
+        """Return the key for a design vector and the values of the parameters."""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(np.ascontiguousarray(x,dtype=float).tobytes())
+        for value in paramValues:
+            h.update(str(value).encode())
+        return h.hexdigest()
+    #end
+
+    def _get(self,query,args):
+        row = self._connection.execute(query,args).fetchone()
+        if row is None: return None
+        return np.frombuffer(row[0],dtype=float).copy()
+    #end
+
+    def getValues(self,key):
+        """Return the function values stored for key, None if there are none."""
+        return self._get("SELECT data FROM funval WHERE key=?",(key,))
+
+    def setValues(self,key,values):
+        """Store the function values for key."""
+        data = np.ascontiguousarray(values,dtype=float).tobytes()
+        self._connection.execute("INSERT OR REPLACE INTO funval VALUES (?,?)",(key,data))
+        self._connection.commit()
+    #end
+
+    def getGradient(self,key,name):
+        """Return the gradient of function "name" stored for key, None if there is none."""
+        return self._get("SELECT data FROM gradient WHERE key=? AND name=?",(key,name))
+
+    def setGradient(self,key,name,gradient):
+        """Store the gradient of function "name" for key."""
+        data = np.ascontiguousarray(gradient,dtype=float).tobytes()
+        self._connection.execute("INSERT OR REPLACE INTO gradient VALUES (?,?,?)",(key,name,data))
+        self._connection.commit()
+    #end
+
+    def close(self):
+        self._connection.close()
+#end
+
+
+class DesignArchiver:
+    """
+    Deletes, moves, or compresses old design directories on a background thread.
+    Directories are first renamed (which is instantaneous) so that their original path
+    can be reused immediately, the slow part of the work is then queued.
+
+    Parameters
+    ----------
+    compress : Archive format (see shutil.make_archive, e.g. "gztar") used for the
+               designs that are kept, None to keep them as directories.
+    maxSize  : Maximum number of queued directories, archive() blocks when the queue is full.
+    archive  : DesignArchive where the kept designs are stored (compress is then ignored).
+    """
+    def __init__(self,compress=None,maxSize=2,archive=None):
+        self._compress = compress
+        self._archive = archive
+        self._queue = queue.Queue(maxSize)
+        self._error = None
+        self._thread = None
+
+    def archive(self,src,dst=None,record=()):
+        """
+        Rename "src" and queue it to be moved to "dst" (or deleted if dst is None),
+        record contains the other arguments of DesignArchive.store (if one is used).
+        """
+        self._raiseError()
+
+        # the staging name is in the same directory to make the rename cheap
+        num = 0
+        while os.path.exists(src+".old"+str(num)): num += 1
+        staging = src+".old"+str(num)
+        os.rename(src,staging)
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work,daemon=True)
+            self._thread.start()
+        #end
+        if dst is not None: dst = os.path.abspath(dst)
+        self._queue.put((os.path.abspath(staging),dst,record))
+    #end
+
+    def flush(self):
+        """Wait for the queued directories to be processed."""
+        self._queue.join()
+        self._raiseError()
+
+    def _raiseError(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+        #end
+    #end
+
+    def _work(self):
+        while True:
+            src,dst,record = self._queue.get()
+            try:
+                if self._archive is not None and dst is not None:
+                    self._archive.store(src,os.path.basename(dst),*record)
+                else:
+                    archiveDesign(src,dst,self._compress)
+            except Exception as err:
+                if self._error is None: self._error = err
+            finally:
+                self._queue.task_done()
+        #end
+    #end
+#end
+
+
+def archiveDesign(src,dst=None,compress=None):
+    """Move the directory "src" to "dst", compressing it (see DesignArchiver), or delete it."""
+    if dst is not None:
+        if compress is None:
+            if os.path.isdir(dst): shutil.rmtree(dst)
+            os.rename(src,dst)
+            return
+        #end
+        shutil.make_archive(dst,compress,src)
+    #end
+    shutil.rmtree(src)
+#end
+
+
+class DesignArchive:
+    """
+    Archive of old designs (see DriverBase.setStorageMode) where identical files are stored
+    once, the design directories contain hard links to a content-addressed object store.
+    Retention rules limit which designs are kept, files matching "drop patterns" are not
+    archived, and an index maps the archived iterations to their function values.
+
+    Parameters
+    ----------
+    dir : Directory of the archive (created if it does not exist), designs are stored in
+          subdirectories, the objects in "objects", and the index in "index.sqlite".
+    tol : Tolerance on the constraint violation for designs to be considered feasible.
+    """
+    def __init__(self,dir,tol=0.0):
+        self._dir = os.path.abspath(dir)
+        self._objects = os.path.join(self._dir,"objects")
+        if not os.path.isdir(self._objects): os.makedirs(self._objects)
+        self._tol = tol
+        self._keepLast = 0
+        self._keepBest = 0
+        self._keepEvery = 0
+        self._dropPatterns = []
+
+        # designs may be stored from a background thread (see DesignArchiver)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self._dir,"index.sqlite"),check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS designs (name TEXT PRIMARY KEY, "+
+                         "iteration INTEGER, objective REAL, violation REAL, kept INTEGER, vals TEXT)")
+        self._db.commit()
+    #end
+
+    def getDir(self):
+        return self._dir
+
+    def setRetention(self,keepLast=0,keepBest=0,keepEvery=0):
+        """
+        Set which designs are kept, the union of: the last "keepLast" designs, the "keepBest"
+        feasible designs with lowest objective, and every "keepEvery"-th iteration.
+        All designs are kept if the three are 0. Removed designs remain in the index.
+        """
+        self._keepLast = keepLast
+        self._keepBest = keepBest
+        self._keepEvery = keepEvery
+    #end
+
+    def addDropPattern(self,pattern):
+        """
+        Files that match the pattern (fnmatch style, e.g. "*.vtu") are not archived, the
+        pattern is matched against the path relative to the design directory and the file name.
+        """
+        self._dropPatterns.append(pattern)
+
+    def _isDropped(self,file):
+        for pattern in self._dropPatterns:
+            if fnmatch.fnmatch(file,pattern) or fnmatch.fnmatch(os.path.basename(file),pattern):
+                return True
+        return False
+    #end
+
+    def store(self,src,name,iteration=0,values=None,objective=None,violation=None):
+        """
+        Move the directory "src" into the archive as "name", replace its files by links to
+        the object store, record the function values (a dictionary) in the index, and
+        apply the retention rules.
+        """
+        dst = os.path.join(self._dir,name)
+        with self._lock:
+            if os.path.isdir(dst): shutil.rmtree(dst)
+            shutil.move(src,dst)
+
+            for root,_,files in os.walk(dst):
+                for file in files:
+                    path = os.path.join(root,file)
+                    if self._isDropped(os.path.relpath(path,dst)):
+                        os.remove(path)
+                    elif not os.path.islink(path):
+                        self._link(path)
+                #end
+            #end
+
+            self._db.execute("INSERT OR REPLACE INTO designs VALUES (?,?,?,?,1,?)",
+                             (name,iteration,objective,violation,json.dumps(values)))
+            self._db.commit()
+            self._applyRetention()
+        #end
+    #end
+
+    # replace the file by a link to the object with the same contents, or create that object
+    def _link(self,path):
+        key = _hashContents(path)
+        obj = os.path.join(self._objects,key[:2],key)
+        if not os.path.isfile(obj):
+            os.makedirs(os.path.dirname(obj),exist_ok=True)
+            if os.stat(path).st_nlink == 1:
+                os.link(path,obj)
+                return
+            #end
+            # files staged by hard link share the inode of the user's data, the object must be
+            # a copy, otherwise editing the data changes the archive and it is never collected
+            tmp = obj+".tmp"+str(os.getpid())
+            shutil.copy2(path,tmp)
+            os.replace(tmp,obj)
+        #end
+        tmp = path+".tmp"+str(os.getpid())
+        os.link(obj,tmp)
+        os.replace(tmp,path)
+    #end
+
+    def _applyRetention(self):
+        if self._keepLast <= 0 and self._keepBest <= 0 and self._keepEvery <= 0: return
+
+        rows = self._db.execute("SELECT name, iteration, objective, violation FROM designs "+
+                                "WHERE kept = 1 ORDER BY iteration").fetchall()
+        keep = set()
+        if self._keepLast > 0:
+            keep.update(row[0] for row in rows[-self._keepLast:])
+        if self._keepBest > 0:
+            feasible = [row for row in rows if row[2] is not None and row[3] is not None \
+                        and row[3] <= self._tol]
+            feasible.sort(key=lambda row: row[2])
+            keep.update(row[0] for row in feasible[0:self._keepBest])
+        #end
+        if self._keepEvery > 0:
+            keep.update(row[0] for row in rows if row[1] % self._keepEvery == 0)
+
+        removed = [row[0] for row in rows if row[0] not in keep]
+        for name in removed:
+            shutil.rmtree(os.path.join(self._dir,name),ignore_errors=True)
+            self._db.execute("UPDATE designs SET kept = 0 WHERE name = ?",(name,))
+        #end
+        self._db.commit()
+        if removed: self._collectGarbage()
+    #end
+
+    # remove the objects that are no longer linked from any design
+    def _collectGarbage(self):
+        for root,_,files in os.walk(self._objects):
+            for file in files:
+                path = os.path.join(root,file)
+                if os.stat(path).st_nlink == 1: os.remove(path)
+            #end
+        #end
+    #end
+
+    def getIndex(self,keptOnly=False):
+        """
+        Return the archived designs, sorted by iteration, as a list of dictionaries with keys
+        "name", "iteration", "objective", "violation", "kept", and "values" (by function name).
+        """
+        query = "SELECT name, iteration, objective, violation, kept, vals FROM designs"
+        if keptOnly: query += " WHERE kept = 1"
+        with self._lock:
+            rows = self._db.execute(query+" ORDER BY iteration").fetchall()
+        keys = ("name","iteration","objective","violation","kept","values")
+        index = [dict(zip(keys,row)) for row in rows]
+        for entry in index:
+            entry["kept"] = bool(entry["kept"])
+            entry["values"] = json.loads(entry["values"])
+        #end
+        return index
+    #end
+
+    def close(self):
+        self._db.close()
+#end
@@ -34,16 +34,26 @@ class LabelReplacer:
         with open(file) as f:
             lines = f.readlines()
 
+        newLines = self.render(lines,value)
+
+        with open(file,"w") as f:
+            f.writelines(newLines)
+    #end
+
+    def render(self,lines,value):
+        """Same as write but for a file already in memory (list of lines), returns the new lines."""
         if isinstance(value,np.ndarray): value = value[0]
 
         newLines = []
         for line in lines:
             newLines.append(line.replace(self._label,str(value)))
         #end
+        return newLines
+    #end
 
-        with open(file,"w") as f:
-            f.writelines(newLines)
-     #end
+    def find(self,lines):
+        """Return the indices of the lines that render changes (those with the label)."""
+        return [i for i,line in enumerate(lines) if self._label in line]
 #end
 
 
@@ -64,6 +74,14 @@ class ArrayLabelReplacer:
         with open(file) as f:
             lines = f.readlines()
 
+        newLines = self.render(lines,value)
+
+        with open(file,"w") as f:
+            f.writelines(newLines)
+    #end
+
+    def render(self,lines,value):
+        """Same as write but for a file already in memory (list of lines), returns the new lines."""
         valueStr = ""
         for v in value:
             valueStr += str(v)+self._delim
@@ -73,10 +91,12 @@ class ArrayLabelReplacer:
         for line in lines:
             newLines.append(line.replace(self._label,valueStr))
         #end
-
-        with open(file,"w") as f:
-            f.writelines(newLines)
+        return newLines
     #end
+
+    def find(self,lines):
+        """Return the indices of the lines that render changes (those with the label)."""
+        return [i for i,line in enumerate(lines) if self._label in line]
 #end
 
 
@@ -121,6 +141,16 @@ class PreStringHandler:
         with open(file) as f:
             lines = f.readlines()
 
+        lines = self.render(lines,value)
+
+        with open(file,"w") as f:
+            f.writelines(lines)
+    #end
+
+    def render(self,lines,value):
+        """Same as write but for a file already in memory (list of lines), returns the new lines."""
+        lines = list(lines)
+
         # make scalars iterable
         if isinstance(value,float) or isinstance(value,int):
             value = [value]
@@ -137,10 +167,12 @@ class PreStringHandler:
                 lines[i] = newLine
             #end
         #end
-
-        with open(file,"w") as f:
-            f.writelines(lines)
+        return lines
     #end
+
+    def find(self,lines):
+        """Return the indices of the lines that render changes (those starting with the label)."""
+        return [i for i,line in enumerate(lines) if line.startswith(self._label)]
 #end
 
 
@@ -172,6 +204,10 @@ class TableReader:
         self._delim = delim
 
     def read(self,file):
+        return self._read(file,self._col)
+
+    # the column is an argument, the parser may be shared by threads
+    def _read(self,file,col):
         with open(file) as f:
             lines = f.readlines()
 
@@ -200,16 +236,16 @@ class TableReader:
         #end
 
         if self._row is None:
-            if self._col is None:
+            if col is None:
                 return data
             else:
-                return data[:,self._col]
+                return data[:,col]
             #end
         else:
-            if self._col is None:
+            if col is None:
                 return data[self._row,:]
             else:
-                return data[self._row,self._col]
+                return data[self._row,col]
             #end
         #end
     #end
@@ -241,8 +277,8 @@ class LabeledTableReader(TableReader):
         with open(file) as f:
             header = f.readline().split(self._delim)
         header = [x.strip() for x in header]
-        self._col = header.index(self._label)
-        data = TableReader.read(self,file)[self._range[0]:self._range[1]]
+        col = header.index(self._label)
+        data = TableReader._read(self,file,col)[self._range[0]:self._range[1]]
         if data.size == 1: data = data[0]
         return data
     #end
@@ -275,8 +311,17 @@ class TableWriter:
         with open(file) as f:
             lines = f.readlines()
 
+        lines = self.render(lines,values)
+
+        # write file
+        with open(file,"w") as f:
+            f.writelines(lines)
+    #end
+
+    def render(self,lines,values):
+        """Same as write but for a file already in memory (list of lines), returns the new lines."""
         # check if the values are remotely compatible with the file
-        if len(lines) < values.shape[0]: return # "soft fail"
+        if len(lines) < values.shape[0]: return lines # "soft fail"
 
         # keep top, bottom, left, and right the same
         newLines = lines[0:self._start[0]]
@@ -320,10 +365,7 @@ class TableWriter:
             newLines.append(newLine.strip()+"\n")
         #end
 
-        # write file
-        with open(file,"w") as f:
-            f.writelines(newLines)
-            f.writelines(footerLines)
+        return newLines+footerLines
     #end
 #end
 
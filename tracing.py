@@ -0,0 +1,131 @@
+#  Copyright 2019-2020, Pedro Gomes.
+#
+#  This file is part of FADO.
+#
+#  FADO is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  FADO is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with FADO.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+
+class Tracer:
+    """
+    Records the timeline of an optimization as spans (name, category, start, end) and
+    writes it in the Chrome trace-event format, to open in Perfetto or about:tracing.
+    The work of the driver is on the "driver" track, each process runs on a "slot"
+    track (slots are numbered from 1 and reused, their number is the concurrency),
+    and the time evaluations wait to be started is shown as asynchronous spans.
+
+    Example
+    -------
+    >>> tracer = Tracer()
+    >>> driver.setTracer(tracer) # before driver.preprocess()
+    >>> ...
+    >>> tracer.write("trace.json")
+    """
+    def __init__(self):
+        self._start = time.time()
+        self._events = []
+        self._slots = []
+        self._numSlots = 0
+        self._numAsync = 0
+        self._lock = threading.Lock()
+
+    # time in microseconds since the tracer was created
+    def _time(self,t):
+        return (t-self._start)*1e6
+
+    def addSpan(self,name,category,start,end,track=0,args=None):
+        """
+        Add a span from "start" to "end" (as given by time.time()) to a track, 0 is the
+        driver track, slots are obtained with acquireSlot.
+        """
+        event = {"name" : name, "cat" : category, "ph" : "X", "pid" : os.getpid(),
+                 "tid" : track, "ts" : self._time(start), "dur" : (end-start)*1e6}
+        if args: event["args"] = args
+        with self._lock:
+            self._events.append(event)
+    #end
+
+    def addAsyncSpan(self,name,category,start,end,args=None):
+        """Add a span that may overlap others, e.g. the time an evaluation is queued."""
+        with self._lock:
+            self._numAsync += 1
+            event = {"name" : name, "cat" : category, "pid" : os.getpid(),
+                     "id" : self._numAsync, "args" : args or {}}
+            self._events.append(dict(event,ph="b",ts=self._time(start)))
+            self._events.append(dict(event,ph="e",ts=self._time(end)))
+        #end
+    #end
+
+    @contextlib.contextmanager
+    def span(self,name,category,track=0,args=None):
+        """Context manager that records the time spent in its block as a span."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.addSpan(name,category,start,time.time(),track,args)
+    #end
+
+    def acquireSlot(self):
+        """Return the lowest free slot track, it must be released with releaseSlot."""
+        with self._lock:
+            slot = 1
+            while slot in self._slots: slot += 1
+            self._slots.append(slot)
+            self._numSlots = max(self._numSlots,slot)
+        #end
+        return slot
+    #end
+
+    def releaseSlot(self,slot):
+        with self._lock:
+            self._slots.remove(slot)
+
+    def getNumSlots(self):
+        """Return the maximum number of slots used so far."""
+        return self._numSlots
+
+    def write(self,file):
+        """Write the trace-event JSON to "file"."""
+        with self._lock:
+            events = list(self._events)
+        numSlots = self.getNumSlots()
+
+        # names and order of the tracks
+        pid = os.getpid()
+        meta = [{"name" : "process_name", "ph" : "M", "pid" : pid, "args" : {"name" : "FADO"}}]
+        for tid in range(numSlots+1):
+            name = "slot %d" % tid if tid else "driver"
+            meta.append({"name" : "thread_name", "ph" : "M", "pid" : pid, "tid" : tid,
+                         "args" : {"name" : name}})
+            meta.append({"name" : "thread_sort_index", "ph" : "M", "pid" : pid, "tid" : tid,
+                         "args" : {"sort_index" : tid}})
+        #end
+
+        with open(file,"w") as f:
+            json.dump({"traceEvents" : meta+events, "displayTimeUnit" : "ms"},f)
+    #end
+#end
+
+
+def traceSpan(tracer,name,category,args=None):
+    """Return tracer.span(name,category,0,args), or a context that does nothing if tracer is None."""
+    if tracer is None: return contextlib.nullcontext()
+    return tracer.span(name,category,0,args)
+#end
@@ -124,6 +124,22 @@ class InputVariable:
 
     def writeToFile(self,file):
         self._parser.write(file,self._x)
+
+    def render(self,lines):
+        """
+        Write the current value to a file already in memory (list of lines), returns the
+        new lines or None if the parser can only write to files (has no "render" method).
+        """
+        if not hasattr(self._parser,"render"): return None
+        return self._parser.render(lines,self._x)
+
+    def findLines(self,lines):
+        """
+        Return the indices of the lines that render changes, render can then be applied to
+        those lines only. Returns None if the parser cannot tell (has no "find" method).
+        """
+        if not hasattr(self._parser,"find"): return None
+        return self._parser.find(lines)
 #end
 
 
@@ -157,11 +173,25 @@ class Parameter:
         self._index = max(0,min(self._upper,self._index-1))
         return self.isAtBottom()
 
-    def writeToFile(self,file):
+    def getValue(self):
+        """Return the current value (converted by "function" if one was given)."""
         value = self._values[self._index]
         if self._function != None:
             value = self._function(value)
-        self._parser.write(file,value)
+        return value
+
+    def writeToFile(self,file):
+        self._parser.write(file,self.getValue())
+
+    def render(self,lines):
+        """See InputVariable.render."""
+        if not hasattr(self._parser,"render"): return None
+        return self._parser.render(lines,self.getValue())
+
+    def findLines(self,lines):
+        """See InputVariable.findLines."""
+        if not hasattr(self._parser,"find"): return None
+        return self._parser.find(lines)
 
     def isAtTop(self):
         """Return True if the current value is the last."""
@@ -0,0 +1,205 @@
+#  Copyright 2019-2020, Pedro Gomes.
+#
+#  This file is part of FADO.
+#
+#  FADO is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  FADO is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with FADO.  If not, see <https://www.gnu.org/licenses/>.
+
+# This module only depends on the standard library, so that it can be started on
+# compute nodes without the rest of FADO, e.g. "python worker.py --port 6000".
+
+import os
+import sys
+import json
+import shutil
+import signal
+import struct
+import argparse
+import tempfile
+import threading
+import socketserver
+import subprocess as sp
+
+
+# Messages are a JSON header (prefixed by its size) followed by the contents of the
+# files listed in the header, the file names are relative to a run directory.
+def sendMessage(sock,header,dir=None,files=()):
+    header = dict(header)
+    header["files"] = []
+    for name in files:
+        stat = os.stat(os.path.join(dir,name))
+        header["files"].append([name,stat.st_size,stat.st_mode & 0o777])
+    #end
+    data = json.dumps(header).encode()
+    sock.sendall(struct.pack("!Q",len(data))+data)
+
+    for name in files:
+        with open(os.path.join(dir,name),"rb") as f:
+            sock.sendfile(f)
+#end
+
+def _receiveExact(sock,size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size-len(data),1<<20))
+        if not chunk: raise ConnectionError("Connection closed.")
+        data += chunk
+    #end
+    return bytes(data)
+#end
+
+def receiveMessage(sock,dir=None):
+    """Receive a message from sock, its files are written to dir, returns the header."""
+    size = struct.unpack("!Q",_receiveExact(sock,8))[0]
+    header = json.loads(_receiveExact(sock,size).decode())
+
+    for name,size,mode in header["files"]:
+        # files cannot be written outside of the run directory
+        name = os.path.normpath(name)
+        if os.path.isabs(name) or name.split(os.sep)[0] == "..":
+            raise ValueError("Invalid file name '"+name+"'.")
+        target = os.path.join(dir,name)
+        if os.path.dirname(name): os.makedirs(os.path.dirname(target),exist_ok=True)
+
+        with open(target,"wb") as f:
+            while size > 0:
+                chunk = _receiveExact(sock,min(size,1<<20))
+                f.write(chunk)
+                size -= len(chunk)
+            #end
+        #end
+        os.chmod(target,mode)
+    #end
+    return header
+#end
+
+def listFiles(dir):
+    """Return the paths (relative to dir) of the files in dir and its subdirectories."""
+    files = []
+    for root,_,names in os.walk(dir):
+        for name in names:
+            files.append(os.path.relpath(os.path.join(root,name),dir))
+    return files
+#end
+
+def _snapshot(dir):
+    snapshot = {}
+    for name in listFiles(dir):
+        stat = os.stat(os.path.join(dir,name))
+        snapshot[name] = (stat.st_size,stat.st_mtime_ns)
+    return snapshot
+#end
+
+
+class _RunHandler(socketserver.BaseRequestHandler):
+    # receive the run directory, run the command, and send back the files it created or modified
+    def handle(self):
+        dir = tempfile.mkdtemp(prefix="FADO_",dir=self.server.scratch)
+        try:
+            request = receiveMessage(self.request,dir)
+            inputs = _snapshot(dir)
+
+            env = dict(os.environ)
+            env.update(request["env"])
+
+            with open(os.path.join(dir,"stdout.txt"),"w") as stdout, \
+                 open(os.path.join(dir,"stderr.txt"),"w") as stderr:
+                process = sp.Popen(request["command"],cwd=dir,shell=True,stdout=stdout,
+                                   stderr=stderr,env=env,start_new_session=True)
+            #end
+
+            # signals for the process arrive while it runs
+            control = threading.Thread(target=self._forwardSignals,args=(process,),daemon=True)
+            control.start()
+            retcode = process.wait()
+
+            outputs = [name for name,stat in _snapshot(dir).items() if inputs.get(name) != stat]
+            sendMessage(self.request,{"returncode" : retcode},dir,outputs)
+        except (OSError,ValueError):
+            pass
+        finally:
+            shutil.rmtree(dir,ignore_errors=True)
+    #end
+
+    def _forwardSignals(self,process):
+        try:
+            while True:
+                _signalGroup(process,receiveMessage(self.request)["signal"])
+        except (OSError,ValueError,KeyError):
+            # the process would be orphaned if the connection is lost
+            _signalGroup(process,signal.SIGKILL)
+        #end
+    #end
+#end
+
+
+def _signalGroup(process,sig):
+    if process.poll() is not None: return
+    try:
+        os.killpg(process.pid,sig)
+    except ProcessLookupError:
+        pass
+#end
+
+
+class WorkerDaemon(socketserver.ThreadingTCPServer):
+    """
+    Executes the runs sent by a WorkerLauncher, each in a temporary directory.
+    The daemon runs arbitrary commands, it should only listen on trusted networks.
+
+    Parameters
+    ----------
+    host    : Address to listen on.
+    port    : Port to listen on, 0 picks a free one (see getAddress).
+    scratch : Directory for the temporary run directories (default from tempfile).
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self,host="localhost",port=0,scratch=None):
+        socketserver.ThreadingTCPServer.__init__(self,(host,port),_RunHandler)
+        self.scratch = scratch
+
+    def getAddress(self):
+        """Return the (host,port) the daemon listens on."""
+        return self.server_address
+
+    def start(self):
+        """Serve requests on a background thread, see also shutdown()."""
+        thread = threading.Thread(target=self.serve_forever,daemon=True)
+        thread.start()
+        return thread
+    #end
+#end
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FADO worker daemon.")
+    parser.add_argument("--host",default="localhost",help="address to listen on")
+    parser.add_argument("--port",type=int,default=6000,help="port to listen on")
+    parser.add_argument("--scratch",default=None,help="directory for the runs")
+    args = parser.parse_args(argv)
+
+    daemon = WorkerDaemon(args.host,args.port,args.scratch)
+    print("FADO worker listening on %s:%d" % daemon.getAddress())
+    sys.stdout.flush()
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+#end
+
+if __name__ == "__main__":
+    main()